@@ -0,0 +1,93 @@
+import os
+import atexit
+import logging
+import threading
+from queue import Queue
+
+import cv2
+
+
+class PhotoWriter:
+    '''
+        Persists downscaled photos in a background thread, so JPEG encoding
+        and disk writes stay off the inference path
+    '''
+    def __init__(self, max_size=0, quality=95, keep_original=False):
+        '''
+            max_size: longest side of stored photo, 0 keeps the size of the decoded image
+            quality: JPEG quality of stored photo
+            keep_original: keep uploaded file and store downscaled copy next to it,
+                otherwise downscaled photo replaces the upload
+        '''
+        self.max_size = max_size
+        self.quality = quality
+        self.keep_original = keep_original
+        self.queue = Queue()
+        self.lock = threading.Lock()
+        self.closed = False
+        self.thread = threading.Thread(target=self.work)
+        self.thread.daemon = True
+        self.thread.start()
+        # daemon thread is killed at exit, queued photos are written first
+        atexit.register(self.close)
+
+    def storage_path(self, file_path):
+        if self.keep_original:
+            root, ext = os.path.splitext(file_path)
+            return root + '_small' + ext
+        return file_path
+
+    def put(self, file_path, img, data=None):
+        '''
+            img: decoded photo to store downscaled, None if only data should be stored
+            data: encoded upload which is not on disk yet
+        '''
+        self.queue.put((file_path, img, data))
+
+    def flush(self):
+        '''
+            block until every queued photo is written
+        '''
+        self.queue.join()
+
+    def close(self):
+        '''
+            write queued photos and stop the thread
+        '''
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+
+        self.queue.put(None)
+        self.thread.join()
+
+    def work(self):
+        while True:
+            task = self.queue.get()
+            if task is None:
+                self.queue.task_done()
+                break
+
+            file_path, img, data = task
+            try:
+                self.write(file_path, img, data)
+            except Exception as e:
+                logging.error('exception text: ' + str(e))
+                logging.error('photo is not stored at path: ' + str(file_path))
+            self.queue.task_done()
+
+    def write(self, file_path, img, data=None):
+        if data is not None and (self.keep_original or img is None):
+            with open(file_path, 'wb') as file:
+                file.write(data)
+
+        if img is None or (self.keep_original and self.max_size <= 0):
+            return
+
+        im_size_max = max(img.shape[0:2])
+        if self.max_size > 0 and im_size_max > self.max_size:
+            im_scale = float(self.max_size) / float(im_size_max)
+            img = cv2.resize(img, None, None, fx=im_scale, fy=im_scale, interpolation=cv2.INTER_AREA)
+
+        cv2.imwrite(self.storage_path(file_path), img, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
@@ -0,0 +1,121 @@
+# cython: boundscheck=False, wraparound=False, cdivision=True
+import numpy as np
+cimport numpy as np
+
+cdef inline double dmax(double a, double b) nogil:
+    return a if a >= b else b
+
+cdef inline double dmin(double a, double b) nogil:
+    return a if a <= b else b
+
+cdef Py_ssize_t suppress(double[:, ::1] boxes, double[::1] areas, Py_ssize_t[::1] order,
+                         Py_ssize_t start, Py_ssize_t end, double thresh, int min_mode, Py_ssize_t max_keep,
+                         unsigned char[::1] suppressed, Py_ssize_t[::1] keep, Py_ssize_t num_keep) nogil:
+    """
+    greedy suppression over boxes[:, start:end], coordinates are laid out as rows
+    sorted by descending score so the inner loop reads memory in order,
+    kept indices order[i] are appended to keep starting at num_keep
+    """
+    cdef Py_ssize_t i, j, kept = 0
+    cdef double ix1, iy1, ix2, iy2, iarea
+    cdef double w, h, inter, ovr
+    cdef double[::1] x1 = boxes[0]
+    cdef double[::1] y1 = boxes[1]
+    cdef double[::1] x2 = boxes[2]
+    cdef double[::1] y2 = boxes[3]
+
+    for i in range(start, end):
+        if suppressed[i]:
+            continue
+        keep[num_keep] = order[i]
+        num_keep += 1
+        kept += 1
+        if max_keep > 0 and kept >= max_keep:
+            break
+
+        ix1 = x1[i]
+        iy1 = y1[i]
+        ix2 = x2[i]
+        iy2 = y2[i]
+        iarea = areas[i]
+        for j in range(i + 1, end):
+            if suppressed[j]:
+                continue
+            w = dmin(ix2, x2[j]) - dmax(ix1, x1[j]) + 1
+            if w <= 0:
+                continue
+            h = dmin(iy2, y2[j]) - dmax(iy1, y1[j]) + 1
+            if h <= 0:
+                continue
+            inter = w * h
+            if min_mode:
+                ovr = inter / dmin(iarea, areas[j])
+            else:
+                ovr = inter / (iarea + areas[j] - inter)
+            if ovr > thresh:
+                suppressed[j] = 1
+    return num_keep
+
+def _sorted_rows(np.ndarray dets, order):
+    boxes = np.ascontiguousarray(dets[order, :4].T)
+    areas = np.ascontiguousarray((boxes[2] - boxes[0] + 1) * (boxes[3] - boxes[1] + 1))
+    return boxes, areas
+
+def box_nms(np.ndarray[np.float64_t, ndim=2] dets, double thresh, int min_mode=0, Py_ssize_t max_keep=0):
+    """
+    :param dets: [N, 5+] float64 (x1, y1, x2, y2, score)
+    :param min_mode: overlap over the smaller box instead of the union
+    :param max_keep: stop after max_keep boxes, 0 keeps all
+    :return: kept indices by descending score
+    """
+    cdef Py_ssize_t ndets = dets.shape[0]
+    # among equal scores the later box goes first
+    order_array = np.ascontiguousarray(np.argsort(dets[:, 4], kind='stable')[::-1], dtype=np.intp)
+    boxes_array, areas_array = _sorted_rows(dets, order_array)
+    cdef Py_ssize_t[::1] order = order_array
+    cdef double[:, ::1] boxes = boxes_array
+    cdef double[::1] areas = areas_array
+    cdef unsigned char[::1] suppressed = np.zeros(ndets, dtype=np.uint8)
+    keep = np.empty(ndets, dtype=np.intp)
+    cdef Py_ssize_t[::1] keep_view = keep
+    cdef Py_ssize_t num_keep
+
+    with nogil:
+        num_keep = suppress(boxes, areas, order, 0, ndets, thresh, min_mode, max_keep, suppressed, keep_view, 0)
+    return keep[:num_keep]
+
+def box_nms_grouped(np.ndarray[np.float64_t, ndim=2] dets, np.ndarray groups, double thresh,
+                    int min_mode=0, Py_ssize_t max_keep=0):
+    """
+    NMS done separately for boxes of each group
+    :param groups: [N] integer group of each box
+    :param max_keep: limit of kept boxes per group, 0 keeps all
+    :return: kept indices, groups in ascending order, by descending score within a group
+    """
+    cdef Py_ssize_t ndets = dets.shape[0]
+    if ndets == 0:
+        return np.zeros(0, dtype=np.intp)
+
+    # sort by group, then by descending score with the later box first among equal scores
+    rank = np.empty(ndets, dtype=np.intp)
+    rank[np.argsort(dets[:, 4], kind='stable')[::-1]] = np.arange(ndets)
+    order_array = np.ascontiguousarray(np.lexsort((rank, groups)), dtype=np.intp)
+    sorted_groups = np.asarray(groups)[order_array]
+    bounds = np.flatnonzero(sorted_groups[1:] != sorted_groups[:ndets - 1]) + 1
+    cdef Py_ssize_t[::1] starts = np.concatenate(([0], bounds)).astype(np.intp)
+    cdef Py_ssize_t[::1] ends = np.concatenate((bounds, [ndets])).astype(np.intp)
+
+    boxes_array, areas_array = _sorted_rows(dets, order_array)
+    cdef Py_ssize_t[::1] order = order_array
+    cdef double[:, ::1] boxes = boxes_array
+    cdef double[::1] areas = areas_array
+    cdef unsigned char[::1] suppressed = np.zeros(ndets, dtype=np.uint8)
+    keep = np.empty(ndets, dtype=np.intp)
+    cdef Py_ssize_t[::1] keep_view = keep
+    cdef Py_ssize_t g, num_keep = 0
+
+    with nogil:
+        for g in range(starts.shape[0]):
+            num_keep = suppress(boxes, areas, order, starts[g], ends[g], thresh, min_mode, max_keep,
+                                suppressed, keep_view, num_keep)
+    return keep[:num_keep]
@@ -135,6 +135,12 @@ ext_modules = [
         extra_compile_args={'gcc': ["-Wno-cpp", "-Wno-unused-function"]},
         include_dirs = [numpy_include]
     ),
+    Extension(
+        "box_nms",
+        ["box_nms.pyx"],
+        extra_compile_args={'gcc': ["-Wno-cpp", "-Wno-unused-function", "-O3"]},
+        include_dirs = [numpy_include]
+    ),
 ]
 
 if CUDA is not None:
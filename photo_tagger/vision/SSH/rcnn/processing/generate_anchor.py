@@ -4,6 +4,7 @@ Generate base anchors on index 0
 from __future__ import print_function
 import sys
 #from builtins import range
+from collections import OrderedDict
 import numpy as np
 from ..cython.anchors import anchors_cython
 
@@ -11,6 +12,43 @@ from ..cython.anchors import anchors_cython
 def anchors_plane(feat_h, feat_w, stride, base_anchor):
     return anchors_cython(feat_h, feat_w, stride, base_anchor)
 
+
+class AnchorPlaneCache(object):
+    """
+    Bounded LRU cache of anchor planes keyed by (height, width, stride).
+    Planes are stored as read-only contiguous float32 arrays of shape (height * width * A, 4)
+    """
+    def __init__(self, capacity=32):
+        self.capacity = capacity
+        self.planes = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, feat_h, feat_w, stride, base_anchor, ctx=None):
+        """
+        :param ctx: mxnet context to keep the plane on as NDArray, numpy array when None
+        """
+        key = (feat_h, feat_w, stride, ctx)
+        plane = self.planes.get(key)
+        if plane is not None:
+            self.hits += 1
+            self.planes.move_to_end(key)
+            return plane
+
+        self.misses += 1
+        plane = anchors_plane(feat_h, feat_w, stride, base_anchor)
+        plane = np.ascontiguousarray(plane.reshape((-1, 4)), dtype=np.float32)
+        if ctx is not None:
+            import mxnet as mx
+            plane = mx.nd.array(plane, ctx=ctx)
+        else:
+            plane.setflags(write=False)
+        self.planes[key] = plane
+        if len(self.planes) > self.capacity:
+            self.planes.popitem(last=False)
+        return plane
+
+
 def generate_anchors(base_size=16, ratios=[0.5, 1, 2],
                      scales=2 ** np.arange(3, 6)):
     """
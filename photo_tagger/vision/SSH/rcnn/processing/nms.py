@@ -1,9 +1,19 @@
 import numpy as np
-from ..cython.cpu_nms import cpu_nms
+try:
+    from ..cython.cpu_nms import cpu_nms
+except ImportError:
+    cpu_nms = None
 try:
     from ..cython.gpu_nms import gpu_nms
 except ImportError:
     gpu_nms = None
+try:
+    from ..cython.box_nms import box_nms as _box_nms, box_nms_grouped as _box_nms_grouped
+except ImportError:
+    _box_nms = None
+    _box_nms_grouped = None
+
+NMS_MODES = {'Union': 0, 'Min': 1}
 
 
 def py_nms_wrapper(thresh):
@@ -15,7 +25,10 @@ def py_nms_wrapper(thresh):
 def cpu_nms_wrapper(thresh):
     def _nms(dets):
         return cpu_nms(dets, thresh)
-    return _nms
+    if cpu_nms is not None:
+        return _nms
+    else:
+        return box_nms_wrapper(thresh)
 
 
 def gpu_nms_wrapper(thresh, device_id):
@@ -24,7 +37,75 @@ def gpu_nms_wrapper(thresh, device_id):
     if gpu_nms is not None:
         return _nms
     else:
-        return cpu_nms_wrapper(thresh)
+        return box_nms_wrapper(thresh)
+
+
+def box_nms_wrapper(thresh, mode='Union', max_keep=0):
+    def _nms(dets):
+        return box_nms(dets, thresh, mode, max_keep)
+    return _nms
+
+
+def box_nms(dets, thresh, mode='Union', max_keep=0):
+    """
+    NMS engine shared by SSH and MTCNN, compiled kernel with numpy fallback.
+    Boxes overlapping a kept box by more than thresh are suppressed
+    :param dets: [[x1, y1, x2, y2, score, ...]]
+    :param mode: 'Union' divides intersection by union, 'Min' by the smaller box
+    :param max_keep: stop after max_keep boxes, 0 keeps all
+    :return: indexes to keep by descending score
+    """
+    dets = np.asarray(dets, dtype=np.float64)
+    if _box_nms is not None:
+        return _box_nms(dets, thresh, NMS_MODES[mode], max_keep)
+
+    order = np.argsort(dets[:, 4], kind='stable')[::-1]
+    return _py_suppress(dets, order, thresh, mode, max_keep)
+
+
+def grouped_nms(dets, groups, thresh, mode='Union', max_keep=0):
+    """
+    NMS done separately for boxes of each group, e.g. image of the batch
+    :param groups: [N] integer group of each box
+    :param max_keep: limit of kept boxes per group, 0 keeps all
+    :return: indexes to keep, groups in ascending order, by descending score within a group
+    """
+    dets = np.asarray(dets, dtype=np.float64)
+    groups = np.asarray(groups, dtype=np.int64)
+    if _box_nms_grouped is not None:
+        return _box_nms_grouped(dets, groups, thresh, NMS_MODES[mode], max_keep)
+
+    keep = [np.zeros(0, dtype=np.intp)]
+    for group in np.unique(groups):
+        idx = np.where(groups == group)[0]
+        order = idx[np.argsort(dets[idx, 4], kind='stable')[::-1]]
+        keep.append(_py_suppress(dets, order, thresh, mode, max_keep))
+    return np.concatenate(keep)
+
+
+def _py_suppress(dets, order, thresh, mode, max_keep):
+    x1, y1, x2, y2 = dets[:, 0], dets[:, 1], dets[:, 2], dets[:, 3]
+    areas = (x2 - x1 + 1) * (y2 - y1 + 1)
+
+    keep = []
+    while order.size > 0:
+        i = order[0]
+        keep.append(i)
+        if max_keep > 0 and len(keep) >= max_keep:
+            break
+        xx1 = np.maximum(x1[i], x1[order[1:]])
+        yy1 = np.maximum(y1[i], y1[order[1:]])
+        xx2 = np.minimum(x2[i], x2[order[1:]])
+        yy2 = np.minimum(y2[i], y2[order[1:]])
+
+        inter = np.maximum(0.0, xx2 - xx1 + 1) * np.maximum(0.0, yy2 - yy1 + 1)
+        if mode == 'Min':
+            ovr = inter / np.minimum(areas[i], areas[order[1:]])
+        else:
+            ovr = inter / (areas[i] + areas[order[1:]] - inter)
+        order = order[np.where(ovr <= thresh)[0] + 1]
+
+    return np.array(keep, dtype=np.intp)
 
 
 def nms(dets, thresh):
@@ -1,5 +1,7 @@
 from __future__ import print_function
 import sys
+import math
+from collections import OrderedDict
 import cv2
 import mxnet as mx
 from mxnet import ndarray as nd
@@ -8,14 +10,25 @@ import numpy.random as npr
 from distutils.util import strtobool
 
 from rcnn.processing.bbox_transform import nonlinear_pred, clip_boxes
-from rcnn.processing.generate_anchor import generate_anchors_fpn, anchors_plane
-from rcnn.processing.nms import gpu_nms_wrapper
+from rcnn.processing.generate_anchor import generate_anchors_fpn, AnchorPlaneCache
+from rcnn.processing.nms import gpu_nms_wrapper, box_nms_wrapper
+from vision.arena import get_arena, normalize_planar
+from vision.device import get_context
 
 
 class SSHDetector:
-  def __init__(self, prefix, epoch, ctx_id=0, test_mode=False):
+  def __init__(self, prefix, epoch, ctx_id=0, device_postprocess=False,
+               max_size=1600, max_batch=8, bucket_step=320, max_executors=None):
+    """
+    :param max_size: longest image side, base executor is bound for (1, max_size, max_size)
+    :param max_batch: largest number of images in one forward
+    :param bucket_step: image sides are padded up to multiples of bucket_step
+    :param max_executors: number of bucket executors kept alive, None keeps one for every reachable shape
+    """
     self.ctx_id = ctx_id
-    self.ctx = mx.gpu(self.ctx_id)
+    # select and decode candidates with mx.nd operators, copy only top boxes to host
+    self.device_postprocess = device_postprocess
+    self.ctx = get_context(self.ctx_id)
     self.fpn_keys = []
     fpn_stride = []
     fpn_base_size = []
@@ -30,117 +43,247 @@ class SSHDetector:
     self._ratios = np.array([1.0]*len(self._feat_stride_fpn))
     self._anchors_fpn = dict(zip(self.fpn_keys, generate_anchors_fpn(base_size=fpn_base_size, scales=self._scales, ratios=self._ratios)))
     self._num_anchors = dict(zip(self.fpn_keys, [anchors.shape[0] for anchors in self._anchors_fpn.values()]))
+    self._anchors_fpn = dict((k, np.ascontiguousarray(v, dtype=np.float32)) for k, v in self._anchors_fpn.items())
+    # inputs come in a handful of shapes, anchor planes are reused between calls
+    self.anchor_cache = AnchorPlaneCache()
     self._rpn_pre_nms_top_n = 1000
     #self._rpn_post_nms_top_n = rpn_post_nms_top_n
     #self.score_threshold = 0.05
     self.nms_threshold = 0.3
     self._bbox_pred = nonlinear_pred
     sym, arg_params, aux_params = mx.model.load_checkpoint(prefix, epoch)
-    self.nms = gpu_nms_wrapper(self.nms_threshold, self.ctx_id)
+    if self.ctx_id >= 0:
+      self.nms = gpu_nms_wrapper(self.nms_threshold, self.ctx_id)
+    else:
+      self.nms = box_nms_wrapper(self.nms_threshold)
     self.pixel_means = np.array([103.939, 116.779, 123.68]) #BGR
+    # means in network channel order, broadcast over (3, H, W)
+    self._channel_means = self.pixel_means[::-1].astype(np.float32).reshape((3, 1, 1))
 
-    if not test_mode:
-      image_size = (640, 640)
-      self.model = mx.mod.Module(symbol=sym, context=self.ctx, label_names = None)
-      self.model.bind(data_shapes=[('data', (1, 3, image_size[0], image_size[1]))], for_training=False)
-      self.model.set_params(arg_params, aux_params)
-    else:
-      from rcnn.core.module import MutableModule
-      image_size = (2400, 2400)
-      data_shape = [('data', (1,3,image_size[0], image_size[1]))]
-      self.model = MutableModule(symbol=sym, data_names=['data'], label_names=None,
-                                context=self.ctx, max_data_shapes=data_shape)
-      self.model.bind(data_shape, None, for_training=False)
-      self.model.set_params(arg_params, aux_params)
+    # images are padded into a few fixed buckets and batches into powers of two, a forward
+    # never exceeds the pixels of the base executor so every bucket shares its memory
+    self._sym = sym
+    self.bucket_step = bucket_step
+    self.max_batch = max_batch
+    self.max_executors = max_executors
+    image_size = self._bucket(max_size, max_size)
+    self.model = mx.mod.Module(symbol=sym, context=self.ctx, label_names = None)
+    self.model.bind(data_shapes=[('data', (1, 3, image_size[0], image_size[1]))], for_training=False)
+    self.model.set_params(arg_params, aux_params)
+    self._base_shape = (1, 3, image_size[0], image_size[1])
+    self._models = OrderedDict()
+    if self.max_executors is None:
+      self.max_executors = len(self._data_shapes()) - 1
+
+  def _bucket(self, height, width):
+    step = float(self.bucket_step)
+    return (int(math.ceil(height / step) * step), int(math.ceil(width / step) * step))
+
+  def _capacity(self, bucket):
+    """
+    Largest power of two batch of bucket within max_batch and the pixels of the base executor
+    """
+    pixels = self._base_shape[2] * self._base_shape[3]
+    capacity = 1
+    while capacity * 2 <= self.max_batch and capacity * 2 * bucket[0] * bucket[1] <= pixels:
+      capacity *= 2
+    return capacity
+
+  def _data_shapes(self):
+    """
+    Every data shape a forward can take, buckets within the base and power of two batches up to their capacity
+    """
+    shapes = []
+    for height in range(self.bucket_step, self._base_shape[2] + 1, self.bucket_step):
+      for width in range(self.bucket_step, self._base_shape[3] + 1, self.bucket_step):
+        batch_size = 1
+        while batch_size <= self._capacity((height, width)):
+          shapes.append((batch_size, 3, height, width))
+          batch_size *= 2
+    return shapes
+
+  def _chunks(self, ims):
+    """
+    Split images into forwards, portrait and landscape images apart and largest first
+    :return: list of (indices, bucket, batch size)
+    """
+    def bucket(indices):
+      return self._bucket(max(ims[i].shape[0] for i in indices), max(ims[i].shape[1] for i in indices))
+
+    chunks = []
+    for portrait in (False, True):
+      order = sorted((i for i in range(len(ims)) if (ims[i].shape[0] > ims[i].shape[1]) == portrait),
+                     key=lambda i: -ims[i].shape[0] * ims[i].shape[1])
+      start = 0
+      while start < len(order):
+        # smaller images may still be longer on one side, the chunk shrinks until it fits
+        end = start + self._capacity(bucket(order[start:start + 1]))
+        while end - start > self._capacity(bucket(order[start:end])):
+          end = start + self._capacity(bucket(order[start:end]))
+        indices = order[start:end]
+
+        batch_size = 1
+        while batch_size < len(indices):
+          batch_size *= 2
+        chunks.append((indices, bucket(indices), batch_size))
+        start += len(indices)
+    return chunks
+
+  def _get_model(self, data_shape):
+    """
+    Executor bound for data_shape, least recently used executors are dropped,
+    the base executor holding the shared memory is always kept
+    """
+    if data_shape == self._base_shape:
+      return self.model
+
+    model = self._models.get(data_shape)
+    if model is not None:
+      self._models.move_to_end(data_shape)
+      return model
+
+    model = mx.mod.Module(symbol=self._sym, context=self.ctx, label_names = None)
+    model.bind(data_shapes=[('data', data_shape)], for_training=False, shared_module=self.model)
+    self._models[data_shape] = model
+    while len(self._models) > self.max_executors:
+      self._models.popitem(last=False)
+    return model
+
+  def _input_tensor(self, images, data_shape):
+    """
+    Mean subtracted planar float32 input, written into the buffer of the thread arena,
+    padding right and below every image and images padding the batch are zero which is the mean pixel
+    """
+    buf = get_arena().get('ssh', data_shape)
+    for i, im in enumerate(images):
+      h, w = im.shape[0], im.shape[1]
+      # BGR (H, W, 3) to RGB (3, H, W) and mean subtraction in one pass
+      normalize_planar(im, buf[i, :, :h, :w], self._channel_means, reverse=True)
+      buf[i, :, h:, :] = 0.0
+      buf[i, :, :h, w:] = 0.0
+    buf[len(images):] = 0.0
+    return buf
 
 
   def detect(self, img, threshold=0.5, scales=[1.0]):
-    proposals_list = []
-    scores_list = []
+    return self.detect_batch([img], threshold, scales)[0]
+
+  def detect_batch(self, images, threshold=0.5, scales=[1.0]):
+    """
+    Detect faces on several images, images of a forward are padded into the bucket
+    of the largest one
+    :return: list of det [N, 5] in coordinates of each image
+    """
+    if len(images) == 0:
+      return []
+    proposals_lists = [[] for _ in images]
+    scores_lists = [[] for _ in images]
 
     for im_scale in scales:
 
       if im_scale!=1.0:
-        im = cv2.resize(img, None, None, fx=im_scale, fy=im_scale, interpolation=cv2.INTER_LINEAR)
+        ims = [cv2.resize(img, None, None, fx=im_scale, fy=im_scale, interpolation=cv2.INTER_LINEAR) for img in images]
       else:
-        im = img
-      im = im.astype(np.float32)
-      #self.model.bind(data_shapes=[('data', (1, 3, image_size[0], image_size[1]))], for_training=False)
-      im_info = [im.shape[0], im.shape[1], im_scale]
-      im_tensor = np.zeros((1, 3, im.shape[0], im.shape[1]))
-      for i in range(3):
-          im_tensor[0, i, :, :] = im[:, :, 2 - i] - self.pixel_means[2 - i]
-      data = nd.array(im_tensor)
-      db = mx.io.DataBatch(data=(data,), provide_data=[('data', data.shape)])
-      self.model.forward(db, is_train=False)
-      net_out = self.model.get_outputs()
-      pre_nms_topN = self._rpn_pre_nms_top_n
-      #post_nms_topN = self._rpn_post_nms_top_n
-      #min_size_dict = self._rpn_min_size_fpn
-
-      for s in self._feat_stride_fpn:
-          if len(scales)>1 and s==32 and im_scale==scales[-1]:
-            continue
-          _key = 'stride%s'%s
-          stride = int(s)
-          idx = 0
-          if s==16:
-            idx=2
-          elif s==8:
-            idx=4
-          print('getting', im_scale, stride, idx, len(net_out), data.shape, file=sys.stderr)
-          scores = net_out[idx].asnumpy()
-          #print(scores.shape)
-          idx+=1
-          #print('scores',stride, scores.shape, file=sys.stderr)
-          scores = scores[:, self._num_anchors['stride%s'%s]:, :, :]
-          bbox_deltas = net_out[idx].asnumpy()
-
-          #if DEBUG:
-          #    print 'im_size: ({}, {})'.format(im_info[0], im_info[1])
-          #    print 'scale: {}'.format(im_info[2])
-
-          _height, _width = int(im_info[0] / stride), int(im_info[1] / stride)
-          height, width = bbox_deltas.shape[2], bbox_deltas.shape[3]
-
-          A = self._num_anchors['stride%s'%s]
-          K = height * width
-
-          anchors = anchors_plane(height, width, stride, self._anchors_fpn['stride%s'%s].astype(np.float32))
-          #print((height, width), (_height, _width), anchors.shape, bbox_deltas.shape, scores.shape, file=sys.stderr)
-          anchors = anchors.reshape((K * A, 4))
-
-          #print('pre', bbox_deltas.shape, height, width)
-          bbox_deltas = self._clip_pad(bbox_deltas, (height, width))
-          #print('after', bbox_deltas.shape, height, width)
-          bbox_deltas = bbox_deltas.transpose((0, 2, 3, 1)).reshape((-1, 4))
-
-          scores = self._clip_pad(scores, (height, width))
-          scores = scores.transpose((0, 2, 3, 1)).reshape((-1, 1))
-
-          #print(anchors.shape, bbox_deltas.shape, A, K, file=sys.stderr)
-          proposals = self._bbox_pred(anchors, bbox_deltas)
-          #proposals = anchors
-
-          proposals = clip_boxes(proposals, im_info[:2])
-
-          #keep = self._filter_boxes(proposals, min_size_dict['stride%s'%s] * im_info[2])
-          #proposals = proposals[keep, :]
-          #scores = scores[keep]
-          #print('333', proposals.shape)
-
-          scores_ravel = scores.ravel()
-          order = scores_ravel.argsort()[::-1]
-          if pre_nms_topN > 0:
-              order = order[:pre_nms_topN]
-          proposals = proposals[order, :]
-          scores = scores[order]
+        ims = images
+      for indices, bucket, batch_size in self._chunks(ims):
+        chunk = [ims[i] for i in indices]
+        im_tensor = self._input_tensor(chunk, (batch_size, 3, bucket[0], bucket[1]))
+        for i, (proposals, scores) in zip(indices, self._forward(im_tensor, chunk, im_scale, threshold, scales)):
+          proposals_lists[i].extend(proposals)
+          scores_lists[i].extend(scores)
+
+    return [self._nms_detections(proposals_list, scores_list, threshold)
+            for proposals_list, scores_list in zip(proposals_lists, scores_lists)]
+
+  def _forward(self, im_tensor, ims, im_scale, threshold, scales):
+    """
+    One forward of a padded batch
+    :return: for every image of ims lists of proposals and scores of each stride
+    """
+    im_infos = [[im.shape[0], im.shape[1], im_scale] for im in ims]
+    data = nd.array(im_tensor, ctx=self.ctx, dtype=np.float32)
+    db = mx.io.DataBatch(data=(data,), provide_data=[('data', data.shape)])
+    model = self._get_model(data.shape)
+    model.forward(db, is_train=False)
+    net_out = model.get_outputs()
+    pre_nms_topN = self._rpn_pre_nms_top_n
+    results = [([], []) for _ in ims]
+
+    for s in self._feat_stride_fpn:
+        if len(scales)>1 and s==32 and im_scale==scales[-1]:
+          continue
+        stride = int(s)
+        idx = 0
+        if s==16:
+          idx=2
+        elif s==8:
+          idx=4
+        if not self.device_postprocess:
+          # one copy to host for the whole batch
+          batch_scores, batch_deltas = net_out[idx].asnumpy(), net_out[idx+1].asnumpy()
+
+        for i, im_info in enumerate(im_infos):
+          if self.device_postprocess:
+            proposals, fg_scores = self._device_proposals(nd.slice_axis(net_out[idx], axis=0, begin=i, end=i+1),
+                                                          nd.slice_axis(net_out[idx+1], axis=0, begin=i, end=i+1),
+                                                          stride, threshold, pre_nms_topN, im_info)
+          else:
+            proposals, fg_scores = self._host_proposals(batch_scores[i:i+1], batch_deltas[i:i+1], stride,
+                                                        threshold, pre_nms_topN, im_info)
 
           proposals /= im_scale
 
-          proposals_list.append(proposals)
-          scores_list.append(scores)
+          results[i][0].append(proposals)
+          results[i][1].append(fg_scores.reshape((-1, 1)))
+    return results
+
+  @staticmethod
+  def _tile_starts(length, tile_size, overlap):
+    if length <= tile_size:
+      return [0]
+    starts = list(range(0, length - tile_size, tile_size - overlap))
+    return starts + [length - tile_size]
+
+  def detect_tiled(self, img, threshold=0.5, tile_size=640, overlap=160, max_batch=8, global_size=None):
+    """
+    Detect faces on overlapping tiles of tile_size run as batches of max_batch, and on the
+    whole image downscaled to global_size for faces larger than a tile or crossing a seam
+    wider than overlap. Boxes of all passes are merged with NMS
+    :param global_size: longest side of the global pass, None uses the side of the base executor
+    :return: det [N, 5] in image coordinates
+    """
+    origins = [(y, x) for y in self._tile_starts(img.shape[0], tile_size, overlap)
+                      for x in self._tile_starts(img.shape[1], tile_size, overlap)]
+    tile_shape = (min(tile_size, img.shape[0]), min(tile_size, img.shape[1]))
+    # tiles run in whole forwards of one executor, the last batch is padded with mean pixel tiles
+    forward = min(self._capacity(self._bucket(tile_shape[0], tile_shape[1])), max_batch)
+    batch = max(max_batch // forward, 1) * forward
+    blank = np.empty(tile_shape + (3,), dtype=img.dtype)
+    blank[:] = np.round(self.pixel_means)
+
+    dets = []
+    for start in range(0, len(origins), batch):
+      batch_origins = origins[start:start + batch]
+      tiles = [img[y:y + tile_size, x:x + tile_size] for y, x in batch_origins]
+      tiles += [blank] * (-len(tiles) % forward)
+      for (y, x), det in zip(batch_origins, self.detect_batch(tiles, threshold)):
+        det[:, [0, 2]] += x
+        det[:, [1, 3]] += y
+        dets.append(det)
 
+    if global_size is None:
+      global_size = self._base_shape[3]
+    im_scale = min(1.0, float(global_size) / max(img.shape[0], img.shape[1]))
+    dets.append(self.detect_batch([img], threshold, scales=[im_scale])[0])
+
+    det = np.vstack(dets)
+    det = det[np.argsort(-det[:, 4], kind='stable')]
+    if self.nms_threshold<1.0:
+      keep = self.nms(det)
+      det = det[keep, :]
+    return det
+
+  def _nms_detections(self, proposals_list, scores_list, threshold):
     proposals = np.vstack(proposals_list)
     scores = np.vstack(scores_list)
     scores_ravel = scores.ravel()
@@ -170,6 +313,102 @@ class SSHDetector:
       det = det[keep, :]
     return det
 
+  @staticmethod
+  def _feat_shape(shape, stride, im_info):
+    """
+    Feature map cells covering the image inside a padded bucket
+    """
+    return (min(shape[2], int(math.ceil(im_info[0] / float(stride)))),
+            min(shape[3], int(math.ceil(im_info[1] / float(stride)))))
+
+  def _host_proposals(self, scores, bbox_deltas, stride, threshold, pre_nms_topN, im_info):
+    """
+    Decode candidate boxes of one stride on host
+    :param scores: [1, 2A, H, W]
+    :param bbox_deltas: [1, 4A, H, W]
+    :return: proposals [N, 4], scores [N]
+    """
+    A = self._num_anchors['stride%s'%stride]
+    scores = scores[:, A:, :, :]
+
+    #if DEBUG:
+    #    print 'im_size: ({}, {})'.format(im_info[0], im_info[1])
+    #    print 'scale: {}'.format(im_info[2])
+
+    # outputs of a padded bucket are cropped back to cells covering the image
+    height, width = self._feat_shape(bbox_deltas.shape, stride, im_info)
+
+    anchors = self.anchor_cache.get(height, width, stride, self._anchors_fpn['stride%s'%stride])
+    #print((height, width), (_height, _width), anchors.shape, bbox_deltas.shape, scores.shape, file=sys.stderr)
+
+    # keep anchors above threshold, then only pre_nms_topN best of them
+    scores = self._clip_pad(scores, (height, width))[0]
+    if threshold>0.0:
+      a, h, w = np.nonzero(scores >= threshold)
+    else:
+      a, h, w = np.indices(scores.shape).reshape((3, -1))
+    fg_scores = scores[a, h, w]
+    if pre_nms_topN > 0 and fg_scores.shape[0] > pre_nms_topN:
+      top = np.argpartition(-fg_scores, pre_nms_topN - 1)[:pre_nms_topN]
+      a, h, w, fg_scores = a[top], h[top], w[top], fg_scores[top]
+
+    # decode boxes only for survivors, deltas are laid out as (A * 4, H, W)
+    bbox_deltas = bbox_deltas[0][(a * 4)[:, np.newaxis] + np.arange(4), h[:, np.newaxis], w[:, np.newaxis]]
+    proposals = self._bbox_pred(anchors[(h * width + w) * A + a], bbox_deltas)
+    proposals = clip_boxes(proposals, im_info[:2])
+    return proposals, fg_scores
+
+  def _device_proposals(self, scores, bbox_deltas, stride, threshold, pre_nms_topN, im_info):
+    """
+    Select top candidates and decode their boxes with mx.nd operators,
+    only pre_nms_topN boxes are copied to host
+    :param scores: NDArray [1, 2A, H, W]
+    :param bbox_deltas: NDArray [1, 4A, H, W]
+    :return: proposals [N, 4], scores [N]
+    """
+    A = self._num_anchors['stride%s'%stride]
+    height, width = self._feat_shape(bbox_deltas.shape, stride, im_info)
+    if (height, width) != bbox_deltas.shape[2:]:
+      scores = nd.slice_axis(nd.slice_axis(scores, axis=2, begin=0, end=height), axis=3, begin=0, end=width)
+      bbox_deltas = nd.slice_axis(nd.slice_axis(bbox_deltas, axis=2, begin=0, end=height), axis=3, begin=0, end=width)
+    K = height * width
+    anchors = self.anchor_cache.get(height, width, stride, self._anchors_fpn['stride%s'%stride], ctx=scores.context)
+
+    # scores and deltas flattened in (A, H, W) order
+    scores = nd.slice_axis(scores, axis=1, begin=A, end=2*A).reshape((-1,))
+    bbox_deltas = bbox_deltas.reshape((A, 4, K)).transpose((0, 2, 1)).reshape((-1, 4))
+    count = A * K
+    if pre_nms_topN > 0:
+      count = min(pre_nms_topN, count)
+    fg_scores, order = nd.topk(scores, k=count, ret_typ='both')
+
+    # anchor planes are laid out as (H, W, A)
+    a = nd.floor(order / K)
+    # rows are x1, y1, x2, y2 and dx, dy, dw, dh
+    anchors = nd.take(anchors, (order - a * K) * A + a).T
+    bbox_deltas = nd.take(bbox_deltas, order).T
+
+    widths = anchors[2] - anchors[0] + 1.0
+    heights = anchors[3] - anchors[1] + 1.0
+    ctr_x = anchors[0] + 0.5 * (widths - 1.0)
+    ctr_y = anchors[1] + 0.5 * (heights - 1.0)
+    pred_ctr_x = bbox_deltas[0] * widths + ctr_x
+    pred_ctr_y = bbox_deltas[1] * heights + ctr_y
+    pred_w = nd.exp(bbox_deltas[2]) * widths
+    pred_h = nd.exp(bbox_deltas[3]) * heights
+    proposals = nd.stack(nd.clip(pred_ctr_x - 0.5 * (pred_w - 1.0), 0, im_info[1] - 1),
+                         nd.clip(pred_ctr_y - 0.5 * (pred_h - 1.0), 0, im_info[0] - 1),
+                         nd.clip(pred_ctr_x + 0.5 * (pred_w - 1.0), 0, im_info[1] - 1),
+                         nd.clip(pred_ctr_y + 0.5 * (pred_h - 1.0), 0, im_info[0] - 1), axis=1)
+
+    proposals = proposals.asnumpy()
+    fg_scores = fg_scores.asnumpy()
+    if threshold>0.0:
+      keep = np.where(fg_scores >= threshold)[0]
+      proposals = proposals[keep]
+      fg_scores = fg_scores[keep]
+    return proposals, fg_scores
+
   @staticmethod
   def _filter_boxes(boxes, min_size):
       """ Remove all boxes with any side smaller than min_size """
@@ -1,8 +1,11 @@
 import cv2
+import os
 import sys
 import numpy as np
 import datetime
 sys.path.append('.')
+# ssh_detector imports vision.arena and vision.device from the photo_tagger root
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
 from ssh_detector import SSHDetector
 
 scales = [1200, 1600]
@@ -0,0 +1,93 @@
+# coding: utf-8
+import threading
+
+import numpy as np
+
+
+class BufferArena(object):
+    """
+        Preprocessing buffers reused between calls. Each stage asks for its buffer by
+        name, the block behind the name grows to the largest request and is handed out
+        as a view of the requested shape, so steady state preprocessing does not allocate
+    """
+    def __init__(self):
+        self.blocks = {}
+
+    def get(self, name, shape, dtype=np.float32):
+        """
+            buffer of the stage, contents are undefined
+
+        Parameters:
+        ----------
+            name: string
+                stage owning the buffer, the buffer is valid until its next get
+            shape: tuple
+                shape of the buffer
+            dtype: numpy dtype
+                type of the buffer
+        Returns:
+        -------
+            contiguous numpy array of shape
+        """
+        dtype = np.dtype(dtype)
+        size = int(np.prod(shape))
+        block = self.blocks.get((name, dtype))
+        if block is None or block.size < size:
+            block = np.empty(size, dtype=dtype)
+            self.blocks[(name, dtype)] = block
+        return block[:size].reshape(shape)
+
+    def zeros(self, name, shape, dtype=np.float32):
+        """
+            zero filled buffer of the stage
+        """
+        buf = self.get(name, shape, dtype)
+        buf.fill(0)
+        return buf
+
+    @property
+    def nbytes(self):
+        return sum(block.nbytes for block in self.blocks.values())
+
+    def clear(self):
+        self.blocks = {}
+
+
+_local = threading.local()
+
+def get_arena():
+    """
+        arena of the calling thread, every worker thread or process has its own
+    """
+    arena = getattr(_local, 'arena', None)
+    if arena is None:
+        arena = _local.arena = BufferArena()
+    return arena
+
+def normalize_planar(img, out, mean, scale=None, reverse=False):
+    """
+        write (h, w, c) image into planar (c, h, w) out as (img - mean) * scale, in place
+
+    Parameters:
+    ----------
+        img: numpy array of shape (h, w, c)
+            input image
+        out: numpy array of shape (c, h, w)
+            float32 output, may be a view into a larger buffer
+        mean: float number or numpy array of shape (c, 1, 1)
+            subtracted in output channel order
+        scale: float number
+            multiplier applied after the mean, None skips it
+        reverse: bool
+            reverse channel order, bgr to rgb
+    Returns:
+    -------
+        out
+    """
+    planes = img.transpose((2, 0, 1))
+    if reverse:
+        planes = planes[::-1]
+    np.subtract(planes, mean, out=out, dtype=out.dtype, casting='unsafe')
+    if scale is not None:
+        out *= scale
+    return out
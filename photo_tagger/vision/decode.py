@@ -0,0 +1,121 @@
+import io
+import os
+import struct
+
+import cv2
+import numpy as np
+
+# start of frame markers, the rest of 0xC0-0xCF are DHT, JPG and DAC
+SOF_MARKERS = set(range(0xC0, 0xD0)) - set([0xC4, 0xC8, 0xCC])
+
+# libjpeg scales DCT blocks by 1/2, 1/4 and 1/8 while decoding
+REDUCED_FLAGS = [
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2),
+]
+
+
+def jpeg_size(stream):
+    '''
+        (height, width) from the frame header of JPEG stream, None if stream is not a JPEG
+    '''
+    if stream.read(2) != b'\xff\xd8':
+        return None
+
+    while True:
+        marker = stream.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            return None
+
+        code = marker[1]
+        # markers may be preceded by fill bytes
+        while code == 0xFF:
+            fill = stream.read(1)
+            if len(fill) == 0:
+                return None
+            code = fill[0]
+
+        # standalone markers without length
+        if code == 0x01 or 0xD0 <= code <= 0xD7:
+            continue
+
+        length = stream.read(2)
+        if len(length) < 2:
+            return None
+
+        if struct.unpack('>H', length)[0] < 2:
+            return None
+
+        if code in SOF_MARKERS:
+            header = stream.read(5)
+            if len(header) < 5:
+                return None
+            _, height, width = struct.unpack('>BHH', header)
+            return height, width
+
+        stream.seek(struct.unpack('>H', length)[0] - 2, os.SEEK_CUR)
+
+
+def image_scale(height, width, target_size, max_size):
+    '''
+        scale to fit image into (target_size, max_size), 1.0 if it already fits
+    '''
+    im_size_min = min(height, width)
+    im_size_max = max(height, width)
+    im_scale = 1.0
+    if im_size_min>target_size or im_size_max>max_size:
+        im_scale = float(target_size) / float(im_size_min)
+        # prevent bigger axis from being more than max_size:
+        if np.round(im_scale * im_size_max) > max_size:
+            im_scale = float(max_size) / float(im_size_max)
+    return im_scale
+
+
+def reduction_factor(height, width, target_size, max_size):
+    '''
+        largest DCT reduction which still decodes image not smaller than its target scale
+    '''
+    im_scale = image_scale(height, width, target_size, max_size)
+    for factor, _ in REDUCED_FLAGS:
+        if factor * im_scale <= 1.0:
+            return factor
+    return 1
+
+
+def photo_size(img_path=None, data=None):
+    '''
+        (height, width) of JPEG photo at path or in encoded bytes from its header,
+        None for other formats or unreadable files
+    '''
+    if data is not None:
+        return jpeg_size(io.BytesIO(data))
+
+    try:
+        with open(img_path, 'rb') as file:
+            return jpeg_size(file)
+    except (IOError, OSError):
+        return None
+
+
+def decode_image(img_path=None, data=None, target_size=None, max_size=None, size=None):
+    '''
+        Decode photo from path or encoded bytes, JPEGs larger than target scale
+        are decoded at reduced resolution so only the remainder has to be resized.
+        size is the header size from photo_size if it is already known.
+        Returns image and the reduction factor used
+    '''
+    factor = 1
+    if target_size is not None and max_size is not None:
+        if size is None:
+            size = photo_size(img_path, data)
+
+        if size is not None:
+            factor = reduction_factor(size[0], size[1], target_size, max_size)
+
+    flags = dict(REDUCED_FLAGS).get(factor, cv2.IMREAD_COLOR)
+    if data is not None:
+        img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), flags)
+    else:
+        img = cv2.imread(img_path, flags)
+    return img, factor
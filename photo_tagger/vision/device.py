@@ -0,0 +1,36 @@
+import os
+import logging
+
+
+def configure_cpu(num_threads=0):
+    '''
+        Setup cpu executors of this process: MKL-DNN operator fusion and thread count.
+        mxnet reads these variables when it is imported, so call it before importing vision models
+    '''
+    # fuse conv/bn/relu chains when mxnet is built with MKL-DNN, ignored by other builds
+    os.environ.setdefault('MXNET_SUBGRAPH_BACKEND', 'MKLDNN')
+
+    if num_threads > 0:
+        os.environ['OMP_NUM_THREADS'] = str(num_threads)
+        os.environ['MXNET_CPU_WORKER_NTHREADS'] = str(num_threads)
+
+
+def mkldnn_enabled():
+    import mxnet as mx
+    try:
+        return mx.runtime.Features().is_enabled('MKLDNN')
+    except AttributeError:
+        return False
+
+
+def get_context(ctx_id):
+    '''
+        mxnet context for given device id, negative id means cpu
+    '''
+    import mxnet as mx
+    if ctx_id >= 0:
+        return mx.gpu(ctx_id)
+
+    if not mkldnn_enabled():
+        logging.warning('mxnet is built without MKL-DNN, cpu inference will be slow')
+    return mx.cpu()
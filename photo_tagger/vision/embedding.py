@@ -4,23 +4,33 @@ import numpy as np
 import sys
 import mxnet as mx
 import datetime
-from skimage import transform as trans
 import sklearn
 from sklearn import preprocessing
+from vision.device import get_context
+from vision.helper import similarity_transforms
+from vision.arena import get_arena
 
 class Embedding:
-  def __init__(self, prefix, epoch, ctx_id=0):
+  def __init__(self, prefix, epoch, ctx_id=0, buckets=(1, 4, 8, 16, 32)):
     print('loading',prefix, epoch)
-    ctx = mx.gpu(ctx_id)
+    ctx = get_context(ctx_id)
     sym, arg_params, aux_params = mx.model.load_checkpoint(prefix, epoch)
     all_layers = sym.get_internals()
     sym = all_layers['fc1_output']
     image_size = (112,112)
     self.image_size = image_size
-    model = mx.mod.Module(symbol=sym, context=ctx, label_names = None)
-    model.bind(for_training=False, data_shapes=[('data', (1, 3, image_size[0], image_size[1]))])
-    model.set_params(arg_params, aux_params)
-    self.model = model
+    # one executor per batch bucket, the largest one owns parameters and memory, the rest share them
+    self.buckets = sorted(buckets)
+    self.models = {}
+    for batch_size in self.buckets[::-1]:
+      model = mx.mod.Module(symbol=sym, context=ctx, label_names = None)
+      shared_module = self.models.get(self.buckets[-1])
+      model.bind(for_training=False, data_shapes=[('data', (batch_size, 3, image_size[0], image_size[1]))],
+                 shared_module=shared_module)
+      if shared_module is None:
+        model.set_params(arg_params, aux_params)
+      self.models[batch_size] = model
+    self.model = self.models[self.buckets[0]]
     src = np.array([
       [30.2946, 51.6963],
       [65.5318, 51.5014],
@@ -30,19 +40,58 @@ class Embedding:
     if image_size[1]==112:
       src[:,0] += 8.0
     self.src = src
-  
+
+  def _bucket(self, num):
+    for batch_size in self.buckets:
+      if batch_size >= num:
+        return batch_size
+    return self.buckets[-1]
+
+  def align(self, rimg, landmarks_list, out=None):
+    """
+    Crop aligned faces, returns (N, 3, 112, 112) uint8 RGB blob, written into out if given
+    """
+    num = len(landmarks_list)
+    if out is None:
+      out = np.empty( (num, 3, self.image_size[0], self.image_size[1]), dtype=np.uint8 )
+    if num == 0:
+      return out
+    chips = get_arena().get('chips', (num, self.image_size[0], self.image_size[1], 3), np.uint8)
+    transforms = similarity_transforms(np.asarray(landmarks_list).reshape((num, 5, 2)), self.src)
+    for i in range(num):
+      cv2.warpAffine(rimg, transforms[i], (self.image_size[1],self.image_size[0]), dst=chips[i], borderValue = 0.0)
+    # BGR -> RGB and NHWC -> NCHW in one copy
+    out[...] = chips[:, :, :, ::-1].transpose((0,3,1,2))
+    return out
+
+  def forward(self, input_blob):
+    """
+    Run aligned faces through the bucket executors, returns (N, 512) normalized embeddings
+    """
+    num = input_blob.shape[0]
+    embeddings = []
+    start = 0
+    while start < num:
+      batch_size = self._bucket(num - start)
+      count = min(batch_size, num - start)
+      data = get_arena().get('embedding', (batch_size,) + input_blob.shape[1:])
+      data[:count] = input_blob[start:start+count]
+      data[count:] = 0.0
+      db = mx.io.DataBatch(data=(mx.nd.array(data),))
+      model = self.models[batch_size]
+      model.forward(db, is_train=False)
+      embeddings.append(model.get_outputs()[0].asnumpy()[:count])
+      start += count
+
+    if len(embeddings) == 0:
+      return np.zeros( (0, 512), dtype=np.float32 )
+
+    embedding = np.vstack(embeddings)
+    return sklearn.preprocessing.normalize(embedding)
+
+  def get_batch(self, rimg, landmarks_list):
+    blob = get_arena().get('blob', (len(landmarks_list), 3, self.image_size[0], self.image_size[1]), np.uint8)
+    return self.forward(self.align(rimg, landmarks_list, out=blob))
+
   def get(self, rimg, landmark5):
-    tform = trans.SimilarityTransform()
-    tform.estimate(landmark5, self.src)
-    M = tform.params[0:2,:]
-    img = cv2.warpAffine(rimg,M,(self.image_size[1],self.image_size[0]), borderValue = 0.0)
-    img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-    img = np.transpose(img, (2,0,1)) #3*112*112, RGB
-    input_blob = np.zeros( (1, 3, self.image_size[1], self.image_size[0]),dtype=np.uint8 )
-    input_blob[0] = img
-    data = mx.nd.array(input_blob)
-    db = mx.io.DataBatch(data=(data,))
-    self.model.forward(db, is_train=False)
-    embedding = self.model.get_outputs()[0].asnumpy()
-    embedding = sklearn.preprocessing.normalize(embedding).flatten()
-    return embedding
\ No newline at end of file
+    return self.get_batch(rimg, [landmark5])[0]
@@ -0,0 +1,200 @@
+# coding: utf-8
+import atexit
+import logging
+import threading
+import multiprocessing
+from multiprocessing import shared_memory
+from queue import Empty
+
+import numpy as np
+
+from vision.helper import detect_first_stage_batch
+
+
+def pnet_worker(model_path, cpu_id, task_queue, result_queue):
+    """
+        serve first stage tasks with a resident PNet
+
+    Parameters:
+    ----------
+        model_path: string
+            prefix of PNet checkpoint
+        cpu_id: int number
+            id of the mx.cpu context of this worker
+        task_queue: Queue
+            (call_id, task_id, shm_name, shape, scale, threshold) tuples, shape is (n, h, w, c)
+            of the images in the segment, None stops the worker
+        result_queue: Queue
+            (call_id, task_id, boxes) tuples, boxes is a list with None for images where
+            nothing is found, or the exception raised by the task
+    """
+    import mxnet as mx
+
+    net = mx.model.FeedForward.load(model_path, 1, ctx=mx.cpu(cpu_id))
+    shm = None
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+
+        call_id, task_id, shm_name, shape, scale, threshold = task
+        try:
+            if shm is None or shm.name != shm_name:
+                if shm is not None:
+                    shm.close()
+                # segment is owned and unlinked by the parent
+                shm = shared_memory.SharedMemory(name=shm_name)
+
+            imgs = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+            boxes = detect_first_stage_batch(imgs, net, scale, threshold)
+            result_queue.put((call_id, task_id, boxes))
+        except Exception as e:
+            result_queue.put((call_id, task_id, e))
+
+    if shm is not None:
+        shm.close()
+
+
+class PNetWorkers(object):
+    """
+        Long-lived processes running the first stage of MTCNN. Images are shared through
+        multiprocessing.shared_memory, only scale and threshold are sent per task
+    """
+    def __init__(self, model_path, num_worker):
+        """
+        Parameters:
+        ----------
+            model_path: string
+                prefix of PNet checkpoint
+            num_worker: int number
+                number of worker processes
+        """
+        # workers load mxnet themselves, forking an initialized engine is not safe
+        self.ctx = multiprocessing.get_context('spawn')
+        self.model_path = model_path
+        self.task_queue = self.ctx.Queue()
+        self.result_queue = self.ctx.Queue()
+        self.lock = threading.Lock()
+        self.shm = None
+        self.call_id = 0
+        self.processes = [self._start(i) for i in range(num_worker)]
+        # shared segment outlives the process unless it is unlinked
+        atexit.register(self.close)
+
+    def _start(self, cpu_id):
+        process = self.ctx.Process(target=pnet_worker,
+                                   args=(self.model_path, cpu_id, self.task_queue, self.result_queue))
+        process.daemon = True
+        process.start()
+        return process
+
+    def _share(self, imgs):
+        """
+            copy images into the shared segment, segment grows to the largest batch seen
+        """
+        if self.shm is None or self.shm.size < imgs.nbytes:
+            if self.shm is not None:
+                self.shm.close()
+                self.shm.unlink()
+            self.shm = shared_memory.SharedMemory(create=True, size=imgs.nbytes)
+
+        np.ndarray(imgs.shape, dtype=np.uint8, buffer=self.shm.buf)[...] = imgs
+        return self.shm.name
+
+    def run(self, imgs, scales, threshold, net):
+        """
+            first stage boxes of every scale for images of the same shape, each scale is
+            one task running PNet once over all images
+
+        Parameters:
+        ----------
+            imgs: list of numpy arrays, bgr order, uint8
+                input images of the same shape
+            scales: list of float
+                scales of the image pyramid
+            threshold: float number
+                PNet threshold
+            net: PNet
+                in process PNet, runs the scales lost with a dead worker
+        Returns:
+        -------
+            list with boxes of each scale for every image, None where nothing is found
+        """
+        with self.lock:
+            # results of calls abandoned after a worker died carry an older call_id
+            self.call_id += 1
+            if not all(process.is_alive() for process in self.processes):
+                self._restart()
+            imgs = np.ascontiguousarray(np.stack(imgs), dtype=np.uint8)
+            shm_name = self._share(imgs)
+            for task_id, scale in enumerate(scales):
+                self.task_queue.put((self.call_id, task_id, shm_name, imgs.shape, scale, threshold))
+
+            results = [None] * len(scales)
+            pending = set(range(len(scales)))
+            error = None
+            while len(pending) > 0:
+                result = self._get_result()
+                if result is None:
+                    logging.warning('PNet worker died, %d first stage scales run in process' % len(pending))
+                    self._restart()
+                    break
+
+                call_id, task_id, boxes = result
+                if call_id != self.call_id:
+                    continue
+                pending.discard(task_id)
+                if isinstance(boxes, Exception):
+                    error = boxes
+                else:
+                    results[task_id] = boxes
+
+            # every result is collected before raising so the next call starts clean
+            if error is not None:
+                raise error
+
+            for task_id in pending:
+                results[task_id] = detect_first_stage_batch(imgs, net, scales[task_id], threshold)
+
+            return [[boxes[k] for boxes in results] for k in range(imgs.shape[0])]
+
+    def _get_result(self):
+        """
+            next result, None once a worker has died
+        """
+        while True:
+            try:
+                return self.result_queue.get(timeout=1.0)
+            except Empty:
+                if not all(process.is_alive() for process in self.processes):
+                    return None
+
+    def _restart(self):
+        """
+            discard queued tasks and replace dead workers
+        """
+        while True:
+            try:
+                self.task_queue.get_nowait()
+            except Empty:
+                break
+
+        for i, process in enumerate(self.processes):
+            if not process.is_alive():
+                process.join()
+                self.processes[i] = self._start(i)
+
+    def close(self):
+        """
+            stop workers and unlink the shared segment, later calls do nothing
+        """
+        for _ in self.processes:
+            self.task_queue.put(None)
+        for process in self.processes:
+            process.join()
+        self.processes = []
+
+        if self.shm is not None:
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
@@ -1,9 +1,15 @@
 # coding: utf-8
 # YuanYang
+import os
+import sys
 import math
 import cv2
 import numpy as np
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'SSH'))
+from rcnn.processing.nms import box_nms
+from vision.arena import get_arena, normalize_planar
+
 
 def nms(boxes, overlap_threshold, mode='Union'):
     """
@@ -21,52 +27,64 @@ def nms(boxes, overlap_threshold, mode='Union'):
     -------
         index array of the selected bbox
     """
-    # if there are no boxes, return an empty list
-    if len(boxes) == 0:
-        return []
-
-    # if the bounding boxes integers, convert them to floats
-    if boxes.dtype.kind == "i":
-        boxes = boxes.astype("float")
-
-    # initialize the list of picked indexes
-    pick = []
+    # one NMS engine with SSH, compiled kernel when it is built
+    return box_nms(boxes, overlap_threshold, mode)
 
-    # grab the coordinates of the bounding boxes
-    x1, y1, x2, y2, score = [boxes[:, i] for i in range(5)]
-
-    area = (x2 - x1 + 1) * (y2 - y1 + 1)
-    idxs = np.argsort(score)
+def similarity_transforms(src, dst):
+    """
+        closed form least squares similarity transforms (Umeyama without reflection)
+        mapping src points to dst points, for all shapes at once
 
-    # keep looping while some indexes still remain in the indexes list
-    while len(idxs) > 0:
-        # grab the last index in the indexes list and add the index value to the list of picked indexes
-        last = len(idxs) - 1
-        i = idxs[last]
-        pick.append(i)
+    Parameters:
+    ----------
+        src: numpy array, n x k x 2
+            points of each shape
+        dst: numpy array, n x k x 2 or k x 2
+            target points, k x 2 is shared by all shapes
+    Returns:
+    -------
+        numpy array, n x 2 x 3
+            affine matrices
+    """
+    src = np.asarray(src, dtype=np.float64)
+    dst = np.broadcast_to(np.asarray(dst, dtype=np.float64), src.shape)
 
-        xx1 = np.maximum(x1[i], x1[idxs[:last]])
-        yy1 = np.maximum(y1[i], y1[idxs[:last]])
-        xx2 = np.minimum(x2[i], x2[idxs[:last]])
-        yy2 = np.minimum(y2[i], y2[idxs[:last]])
+    src_mean = src.mean(axis=1, keepdims=True)
+    dst_mean = dst.mean(axis=1, keepdims=True)
+    src_demean = src - src_mean
+    dst_demean = dst - dst_mean
 
-        # compute the width and height of the bounding box
-        w = np.maximum(0, xx2 - xx1 + 1)
-        h = np.maximum(0, yy2 - yy1 + 1)
+    # rotation with scale is [[a, -b], [b, a]], least squares solution in closed form
+    norm = (src_demean ** 2).sum(axis=(1, 2))
+    norm[norm == 0] = 1.0
+    a = (src_demean * dst_demean).sum(axis=(1, 2)) / norm
+    b = (src_demean[:, :, 0] * dst_demean[:, :, 1] - src_demean[:, :, 1] * dst_demean[:, :, 0]).sum(axis=1) / norm
 
-        inter = w * h
-        if mode == 'Min':
-            overlap = inter / np.minimum(area[i], area[idxs[:last]])
-        else:
-            overlap = inter / (area[i] + area[idxs[:last]] - inter)
+    M = np.empty((src.shape[0], 2, 3))
+    M[:, 0, 0] = a
+    M[:, 0, 1] = -b
+    M[:, 1, 0] = b
+    M[:, 1, 1] = a
+    M[:, :, 2] = dst_mean[:, 0, :] - np.einsum('nij,nj->ni', M[:, :, :2], src_mean[:, 0, :])
+    return M
 
-        # delete all indexes from the index list that have
-        idxs = np.delete(idxs, np.concatenate(([last],
-                                               np.where(overlap > overlap_threshold)[0])))
+def transform_points(M, points):
+    """
+        apply affine matrices to points
 
-    return pick
+    Parameters:
+    ----------
+        M: numpy array, n x 2 x 3
+            affine matrices
+        points: numpy array, n x k x 2
+            points, each shape is mapped with its own matrix
+    Returns:
+    -------
+        numpy array, n x k x 2
+    """
+    return np.einsum('nij,nkj->nki', M[:, :, :2], points) + M[:, np.newaxis, :, 2]
 
-def adjust_input(in_data):
+def adjust_input(in_data, out=None):
     """
         adjust the input from (h, w, c) to ( 1, c, h, w) for network input
 
@@ -74,20 +92,69 @@ def adjust_input(in_data):
     ----------
         in_data: numpy array of shape (h, w, c)
             input data
+        out: numpy array of shape (1, c, h, w)
+            float32 output, e.g. a slice of an arena buffer, None allocates a new array
     Returns:
     -------
         out_data: numpy array of shape (1, c, h, w)
             reshaped array
     """
-    if in_data.dtype is not np.dtype('float32'):
-        out_data = in_data.astype(np.float32)
-    else:
-        out_data = in_data
+    if out is None:
+        out = np.empty((1, in_data.shape[2]) + in_data.shape[0:2], dtype=np.float32)
 
-    out_data = out_data.transpose((2,0,1))
-    out_data = np.expand_dims(out_data, 0)
-    out_data = (out_data - 127.5)*0.0078125
-    return out_data
+    normalize_planar(in_data, out[0], 127.5, 0.0078125)
+    return out
+
+# cv2.remap maps are limited to SHRT_MAX rows
+REMAP_MAX_ROWS = 32767
+
+def crop_resize(img, boxes, size, out, rows=None, dtype=np.uint8):
+    """
+        crop boxes from image, resize them bilinearly and write them normalized
+        into network input, pixels outside of the image are zero as in a padded crop
+
+    Parameters:
+    ----------
+        img: numpy array of shape (h, w, c)
+            input image, converted to dtype if it has another type, callers
+            cropping the same image again pass it converted
+        boxes: numpy array, n x 4
+            inclusive integer boxes (x1, y1, x2, y2), may exceed the image
+        size: int number
+            network input size
+        out: numpy array of shape (m, c, size, size)
+            float32 input buffer, may be a channel slice of a larger buffer
+        rows: numpy array, n
+            rows of out the crops are written to, None writes out[0:n]
+        dtype: numpy dtype
+            type of the crop while resizing, as the type of the padded crop
+    """
+    if img.dtype != dtype:
+        img = img.astype(dtype)
+
+    x1, y1 = boxes[:, 0:1], boxes[:, 1:2]
+    w, h = boxes[:, 2:3] - x1 + 1, boxes[:, 3:4] - y1 + 1
+
+    # sampling positions of cv2.resize, clamped to the crop as it replicates its border
+    grid = (np.arange(size) + 0.5) / size
+    map_x = (x1 + np.clip(grid * w - 0.5, 0, w - 1)).astype(np.float32)
+    map_y = (y1 + np.clip(grid * h - 0.5, 0, h - 1)).astype(np.float32)
+
+    chunk = max(REMAP_MAX_ROWS // size, 1)
+    for start in range(0, boxes.shape[0], chunk):
+        end = min(start + chunk, boxes.shape[0])
+        num = end - start
+        # crops of the chunk are stacked vertically in one remap
+        xs = np.broadcast_to(map_x[start:end, np.newaxis, :], (num, size, size)).reshape((num * size, size))
+        ys = np.broadcast_to(map_y[start:end, :, np.newaxis], (num, size, size)).reshape((num * size, size))
+        crops = cv2.remap(img, xs, ys, cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+        crops = crops.reshape((num, size, size, -1)).transpose((0, 3, 1, 2))
+
+        if rows is None:
+            np.subtract(crops, 127.5, out=out[start:end], casting='unsafe')
+            out[start:end] *= 0.0078125
+        else:
+            out[rows[start:end]] = (crops - np.float32(127.5)) * np.float32(0.0078125)
 
 def generate_bbox(map, reg, scale, threshold):
      """
@@ -145,24 +212,129 @@ def detect_first_stage(img, net, scale, threshold):
     -------
         total_boxes : bboxes
     """
-    height, width, _ = img.shape
+    return detect_first_stage_batch([img], net, scale, threshold)[0]
+
+def detect_first_stage_batch(imgs, net, scale, threshold):
+    """
+        run PNet for first stage on images of the same shape in one forward
+
+    Parameters:
+    ----------
+        imgs: list of numpy arrays or numpy array (n, h, w, c), bgr order
+            input images of the same shape
+        net: PNet
+            worker
+        scale: float number
+            how much should the input images scale
+        threshold: float number
+            PNet threshold
+    Returns:
+    -------
+        list of bboxes for each image, None where nothing is found
+    """
+    height, width, channels = imgs[0].shape
     hs = int(math.ceil(height * scale))
     ws = int(math.ceil(width * scale))
-    
-    im_data = cv2.resize(img, (ws,hs))
-    
-    # adjust for the network input
-    input_buf = adjust_input(im_data)
+
+    arena = get_arena()
+    input_buf = arena.get('pnet', (len(imgs), channels, hs, ws))
+    for k, img in enumerate(imgs):
+        im_data = cv2.resize(img, (ws,hs), dst=arena.get('pnet_resize', (hs, ws, channels), img.dtype))
+        # adjust for the network input
+        adjust_input(im_data, out=input_buf[k:k+1])
     output = net.predict(input_buf)
-    boxes = generate_bbox(output[1][0,1,:,:], output[0], scale, threshold)
 
-    if boxes.size == 0:
-        return None
+    results = []
+    for k in range(len(imgs)):
+        boxes = generate_bbox(output[1][k,1,:,:], output[0][k:k+1], scale, threshold)
+        if boxes.size == 0:
+            results.append(None)
+            continue
+
+        # nms
+        pick = nms(boxes[:,0:5], 0.5, mode='Union')
+        results.append(boxes[pick])
+    return results
+
+def pyramid_layout(height, width, scales):
+    """
+        pack pyramid levels into one canvas, shelves of levels are stacked below the largest one
+
+    Parameters:
+    ----------
+        height, width: int number
+            size of the input image
+        scales: list of float
+            scales of the pyramid, largest first
+    Returns:
+    -------
+        (canvas_height, canvas_width), list of (scale, y, x, hs, ws) for each level
+    """
+    levels = []
+    canvas_width = 0
+    shelf_y, shelf_x, shelf_height = 0, 0, 0
+    for scale in scales:
+        hs = int(math.ceil(height * scale))
+        ws = int(math.ceil(width * scale))
+        if len(levels) == 0:
+            canvas_width = ws + ws % 2
+        elif shelf_x + ws > canvas_width:
+            shelf_y, shelf_x, shelf_height = shelf_y + shelf_height, 0, 0
+
+        # even offsets keep the stride 2 grid of PNet aligned with every level
+        levels.append((scale, shelf_y, shelf_x, hs, ws))
+        shelf_x += ws + ws % 2
+        shelf_height = max(shelf_height, hs + hs % 2)
+
+    return (shelf_y + shelf_height, canvas_width), levels
+
+def pyramid_canvas(img, canvas_shape, levels, out=None):
+    """
+        resized levels of img placed into a canvas of canvas_shape, written into out if given
+    """
+    canvas = out if out is not None else np.empty((canvas_shape[0], canvas_shape[1], img.shape[2]), dtype=img.dtype)
+    canvas.fill(0)
+    arena = get_arena()
+    for scale, y, x, hs, ws in levels:
+        canvas[y:y+hs, x:x+ws] = cv2.resize(img, (ws, hs), dst=arena.get('pnet_resize', (hs, ws, img.shape[2]), img.dtype))
+    return canvas
+
+def packed_first_stage(output, k, levels, threshold):
+    """
+        first stage boxes of each level from PNet output over packed canvases
+
+    Parameters:
+    ----------
+        output: list of numpy arrays
+            PNet output (reg, prob) for a batch of canvases
+        k: int number
+            index of the canvas in the batch
+        levels: list of (scale, y, x, hs, ws)
+            layout of the canvas
+        threshold: float number
+            PNet threshold
+    Returns:
+    -------
+        list of boxes for each level, None where nothing is found
+    """
+    stride = 2
+    cellsize = 12
+
+    level_boxes = []
+    for scale, y, x, hs, ws in levels:
+        # only cells whose window is inside the level, the rest straddles neighbours
+        row, col = y // stride, x // stride
+        rows, cols = (hs - cellsize) // stride + 1, (ws - cellsize) // stride + 1
+        if rows <= 0 or cols <= 0:
+            level_boxes.append(None)
+            continue
 
-    # nms
-    pick = nms(boxes[:,0:5], 0.5, mode='Union')
-    boxes = boxes[pick]
-    return boxes
+        boxes = generate_bbox(output[1][k, 1, row:row+rows, col:col+cols],
+                              output[0][k:k+1, :, row:row+rows, col:col+cols], scale, threshold)
+        if boxes.size == 0:
+            level_boxes.append(None)
+            continue
 
-def detect_first_stage_warpper( args ):
-    return detect_first_stage(*args)
+        pick = nms(boxes[:,0:5], 0.5, mode='Union')
+        level_boxes.append(boxes[pick])
+    return level_boxes
@@ -4,13 +4,12 @@ import mxnet as mx
 import numpy as np
 import math
 import cv2
-from multiprocessing import Pool
-from itertools import repeat
-try:
-    from itertools import izip
-except:
-    izip = zip
-from vision.helper import nms, adjust_input, generate_bbox, detect_first_stage_warpper
+from collections import OrderedDict
+from vision.helper import nms, adjust_input, detect_first_stage, detect_first_stage_batch, crop_resize
+from vision.helper import pyramid_layout, pyramid_canvas, packed_first_stage, similarity_transforms
+from rcnn.processing.nms import grouped_nms
+from vision.first_stage import PNetWorkers
+from vision.arena import get_arena
 
 class MtcnnDetector(object):
     """
@@ -23,7 +22,8 @@ class MtcnnDetector(object):
                  factor = 0.709,
                  num_worker = 1,
                  accurate_landmark = False,
-                 ctx=mx.cpu()):
+                 ctx=mx.cpu(),
+                 packed_pyramid = False):
         """
             Initialize the detector
 
@@ -38,9 +38,13 @@ class MtcnnDetector(object):
                 factor: float number
                     scale factor for image pyramid
                 num_worker: int number
-                    number of processes we use for first stage
+                    number of processes we use for first stage, 1 runs it in this process
                 accurate_landmark: bool
                     use accurate landmark localization or not
+                ctx: mxnet context
+                    device for RNet, ONet and LNet, PNet always runs on cpu
+                packed_pyramid: bool
+                    pack all pyramid levels into one canvas and run PNet once
 
         """
         self.num_worker = num_worker
@@ -50,26 +54,38 @@ class MtcnnDetector(object):
         models = ['det1', 'det2', 'det3','det4']
         models = [ os.path.join(model_folder, f) for f in models]
         
-        self.PNets = []
-        for i in range(num_worker):
-            workner_net = mx.model.FeedForward.load(models[0], 1, ctx=mx.cpu(i))
-            self.PNets.append(workner_net)
+        self.PNets = [mx.model.FeedForward.load(models[0], 1, ctx=mx.cpu())]
 
-        self.Pool = Pool(num_worker)
+        # PNet stays resident in worker processes, only scales travel per image
+        self.first_stage = None
+        if num_worker > 1:
+            self.first_stage = PNetWorkers(models[0], num_worker)
 
         # self.RNet = mx.model.FeedForward.load(models[1], 1, ctx=mx.cpu())
         # self.ONet = mx.model.FeedForward.load(models[2], 1, ctx=mx.cpu())
         # self.LNet = mx.model.FeedForward.load(models[3], 1, ctx=mx.cpu())
 
-        self.RNet = mx.model.FeedForward.load(models[1], 1, ctx=mx.gpu())
-        self.ONet = mx.model.FeedForward.load(models[2], 1, ctx=mx.gpu())
-        self.LNet = mx.model.FeedForward.load(models[3], 1, ctx=mx.gpu())
+        self.RNet = mx.model.FeedForward.load(models[1], 1, ctx=ctx)
+        self.ONet = mx.model.FeedForward.load(models[2], 1, ctx=ctx)
+        self.LNet = mx.model.FeedForward.load(models[3], 1, ctx=ctx)
+
+        self.packed_pyramid = packed_pyramid
+        # canvas layouts by input shape, at most 32 are kept
+        self.layouts = OrderedDict()
 
         self.minsize   = float(minsize)
         self.factor    = float(factor)
         self.threshold = threshold
 
 
+    def close(self):
+        """
+            stop first stage workers
+        """
+        if self.first_stage is not None:
+            self.first_stage.close()
+            self.first_stage = None
+
     def convert_to_square(self, bbox):
         """
             convert bbox to square
@@ -175,21 +191,66 @@ class MtcnnDetector(object):
 
         return  return_list
 
-    def slice_index(self, number):
+    def pyramid_scales(self, height, width):
         """
-            slice the index into (n,n,m), m < n
+            scales of the image pyramid for the first stage
         Parameters:
         ----------
-            number: int number
-                number
-        """
-        def chunks(l, n):
-            """Yield successive n-sized chunks from l."""
-            for i in range(0, len(l), n):
-                yield l[i:i + n]
-        num_list = range(number)
-        return list(chunks(num_list, self.num_worker))
-        
+            height, width: int number
+                size of the input image
+        """
+        MIN_DET_SIZE = 12
+
+        minl = min( height, width)
+
+        scales = []
+        m = MIN_DET_SIZE/self.minsize
+        minl *= m
+        factor_count = 0
+        while minl > MIN_DET_SIZE:
+            scales.append(m*self.factor**factor_count)
+            minl *= self.factor
+            factor_count += 1
+        return scales
+
+    def canvas_layout(self, height, width):
+        """
+            packed pyramid layout for images of (height, width)
+        """
+        key = (height, width)
+        layout = self.layouts.get(key)
+        if layout is None:
+            layout = pyramid_layout(height, width, self.pyramid_scales(height, width))
+            self.layouts[key] = layout
+            if len(self.layouts) > 32:
+                self.layouts.popitem(last=False)
+        else:
+            self.layouts.move_to_end(key)
+        return layout
+
+    def first_stage_packed(self, imgs):
+        """
+            first stage over packed pyramids, one PNet forward for all images
+        Parameters:
+        ----------
+            imgs: list of numpy arrays
+                input images of the same shape
+        Returns:
+        -------
+            list with boxes of each level for every image, None where nothing is found
+        """
+        height, width, _ = imgs[0].shape
+        canvas_shape, levels = self.canvas_layout(height, width)
+        if len(levels) == 0:
+            return [[] for _ in imgs]
+
+        arena = get_arena()
+        input_buf = arena.get('pnet', (len(imgs), 3) + canvas_shape)
+        for k, img in enumerate(imgs):
+            canvas = arena.get('pnet_canvas', canvas_shape + (3,), img.dtype)
+            adjust_input(pyramid_canvas(img, canvas_shape, levels, out=canvas), out=input_buf[k:k+1])
+        output = self.PNets[0].predict(input_buf)
+        return [packed_first_stage(output, k, levels, self.threshold[0]) for k in range(len(imgs))]
 
     def detect_face(self, img):
         """
@@ -206,9 +267,6 @@ class MtcnnDetector(object):
                 landmarks
         """
 
-        # check input
-        MIN_DET_SIZE = 12
-
         if img is None:
             return None
 
@@ -220,32 +278,19 @@ class MtcnnDetector(object):
         total_boxes = []
 
         height, width, _ = img.shape
-        minl = min( height, width)
 
         # get all the valid scales
-        scales = []
-        m = MIN_DET_SIZE/self.minsize
-        minl *= m
-        factor_count = 0
-        while minl > MIN_DET_SIZE:
-            scales.append(m*self.factor**factor_count)
-            minl *= self.factor
-            factor_count += 1
+        scales = self.pyramid_scales(height, width)
 
         #############################################
         # first stage
         #############################################
-        #for scale in scales:
-        #    return_boxes = self.detect_first_stage(img, scale, 0)
-        #    if return_boxes is not None:
-        #        total_boxes.append(return_boxes)
-        
-        sliced_index = self.slice_index(len(scales))
-        total_boxes = []
-        for batch in sliced_index:
-            local_boxes = self.Pool.map( detect_first_stage_warpper, \
-                    izip(repeat(img), self.PNets[:len(batch)], [scales[i] for i in batch], repeat(self.threshold[0])) )
-            total_boxes.extend(local_boxes)
+        if self.packed_pyramid:
+            total_boxes = self.first_stage_packed([img])[0]
+        elif self.first_stage is not None:
+            total_boxes = self.first_stage.run([img], scales, self.threshold[0], self.PNets[0])[0]
+        else:
+            total_boxes = [detect_first_stage(img, self.PNets[0], scale, self.threshold[0]) for scale in scales]
         
         # remove the Nones 
         total_boxes = [ i for i in total_boxes if i is not None]
@@ -282,15 +327,8 @@ class MtcnnDetector(object):
         #############################################
         num_box = total_boxes.shape[0]
 
-        # pad the bbox
-        [dy, edy, dx, edx, y, ey, x, ex, tmpw, tmph] = self.pad(total_boxes, width, height)
         # (3, 24, 24) is the input shape for RNet
-        input_buf = np.zeros((num_box, 3, 24, 24), dtype=np.float32)
-
-        for i in range(num_box):
-            tmp = np.zeros((tmph[i], tmpw[i], 3), dtype=np.uint8)
-            tmp[dy[i]:edy[i]+1, dx[i]:edx[i]+1, :] = img[y[i]:ey[i]+1, x[i]:ex[i]+1, :]
-            input_buf[i, :, :, :] = adjust_input(cv2.resize(tmp, (24, 24)))
+        input_buf = self.crop_boxes([img], total_boxes, np.zeros(num_box, dtype=np.int32), 24)
 
         output = self.RNet.predict(input_buf)
 
@@ -316,15 +354,10 @@ class MtcnnDetector(object):
         #############################################
         num_box = total_boxes.shape[0]
 
-        # pad the bbox
-        [dy, edy, dx, edx, y, ey, x, ex, tmpw, tmph] = self.pad(total_boxes, width, height)
-        # (3, 48, 48) is the input shape for ONet
-        input_buf = np.zeros((num_box, 3, 48, 48), dtype=np.float32)
+        float_imgs = self.float_images([img], [0])
 
-        for i in range(num_box):
-            tmp = np.zeros((tmph[i], tmpw[i], 3), dtype=np.float32)
-            tmp[dy[i]:edy[i]+1, dx[i]:edx[i]+1, :] = img[y[i]:ey[i]+1, x[i]:ex[i]+1, :]
-            input_buf[i, :, :, :] = adjust_input(cv2.resize(tmp, (48, 48)))
+        # (3, 48, 48) is the input shape for ONet
+        input_buf = self.crop_boxes(float_imgs, total_boxes, np.zeros(num_box, dtype=np.int32), 48, np.float32)
 
         output = self.ONet.predict(input_buf)
 
@@ -357,6 +390,238 @@ class MtcnnDetector(object):
         #############################################
         # extended stage
         #############################################
+        points = self.refine_landmarks(float_imgs, total_boxes, points, np.zeros(total_boxes.shape[0], dtype=np.int32))
+
+        return total_boxes, points
+
+
+    def nms_by_owner(self, boxes, owners, overlap_threshold, mode):
+        """
+            non max suppression done separately for boxes of each image
+        Parameters:
+        ----------
+            boxes: numpy array, n x 5
+                input bboxes
+            owners: numpy array, n
+                index of the image each box belongs to
+        Returns:
+        -------
+            index array of the selected bbox
+        """
+        return grouped_nms(boxes, owners, overlap_threshold, mode).astype(np.int64)
+
+    def float_images(self, imgs, owned):
+        """
+            float32 copies of images for the ONet and LNet crops, converted once for all
+            of them into one buffer of the thread arena
+        Parameters:
+        ----------
+            imgs: list of numpy arrays
+                input images
+            owned: list of int
+                indexes of the images with boxes left
+        Returns:
+        -------
+            list of float32 images, None for images not in owned
+        """
+        buf = get_arena().get('float_img', (sum(imgs[i].size for i in owned),))
+        float_imgs = [None] * len(imgs)
+        start = 0
+        for i in owned:
+            float_imgs[i] = buf[start:start + imgs[i].size].reshape(imgs[i].shape)
+            np.copyto(float_imgs[i], imgs[i], casting='unsafe')
+            start += imgs[i].size
+        return float_imgs
+
+    def crop_boxes(self, imgs, boxes, owners, size, dtype=np.uint8):
+        """
+            crop boxes from their images and prepare them as network input
+        Parameters:
+        ----------
+            imgs: list of numpy arrays
+                input images
+            boxes: numpy array, n x 5
+                square bboxes, clipped to their image inplace as detect_face does
+            owners: numpy array, n
+                index of the image each box belongs to
+            size: int number
+                network input size
+            dtype: numpy dtype
+                type of the crop before resizing, images of another type are converted on every call
+        Returns:
+        -------
+            numpy array, n x 3 x size x size, buffer of the thread arena
+        """
+        input_buf = get_arena().get('crop%d' % size, (boxes.shape[0], 3, size, size))
+        for owner in np.unique(owners):
+            idx = np.where(owners == owner)[0]
+            img = imgs[owner]
+            height, width, _ = img.shape
+            owner_boxes = boxes[idx]
+            # crops are taken from the boxes before pad clips them
+            crop_resize(img, owner_boxes[:, 0:4].astype(np.int32), size, input_buf, idx, dtype)
+            self.pad(owner_boxes, width, height)
+            boxes[idx] = owner_boxes
+
+        return input_buf
+
+    def detect_faces(self, imgs):
+        """
+            detect faces over several images, every stage runs once for all of them
+        Parameters:
+        ----------
+            imgs: list of numpy arrays, bgr order of shape (n, m, 3)
+                input images, e.g. face chips of one photo
+        Retures:
+        -------
+            list with result of detect_face for each image:
+            None or (bboxes, points)
+        """
+        results = [None] * len(imgs)
+
+        #############################################
+        # first stage
+        #############################################
+        # images of the same shape share the pyramid, each scale is one PNet forward for all of them
+        groups = {}
+        for i, img in enumerate(imgs):
+            if img is not None and len(img.shape) == 3:
+                groups.setdefault(img.shape, []).append(i)
+
+        first_stage = [[] for _ in imgs]
+        for shape, idx in groups.items():
+            group = [imgs[i] for i in idx]
+            if self.packed_pyramid:
+                level_boxes = self.first_stage_packed(group)
+            else:
+                scales = self.pyramid_scales(shape[0], shape[1])
+                if self.first_stage is not None:
+                    level_boxes = self.first_stage.run(group, scales, self.threshold[0], self.PNets[0])
+                else:
+                    level_boxes = list(zip(*[detect_first_stage_batch(group, self.PNets[0], scale, self.threshold[0])
+                                             for scale in scales]))
+
+            for i, boxes in zip(idx, level_boxes):
+                first_stage[i].extend(level for level in boxes if level is not None)
+
+        total_boxes = []
+        owners = []
+        for i, boxes in enumerate(first_stage):
+            if len(boxes) == 0:
+                continue
+
+            boxes = np.vstack(boxes)
+
+            # merge the detection from first stage
+            pick = nms(boxes[:, 0:5], 0.7, 'Union')
+            boxes = boxes[pick]
+            total_boxes.append(boxes)
+            owners.append(np.full(boxes.shape[0], i))
+
+        if len(total_boxes) == 0:
+            return results
+
+        total_boxes = np.vstack(total_boxes)
+        owners = np.concatenate(owners)
+
+        bbw = total_boxes[:, 2] - total_boxes[:, 0] + 1
+        bbh = total_boxes[:, 3] - total_boxes[:, 1] + 1
+
+        # refine the bboxes
+        total_boxes = np.vstack([total_boxes[:, 0]+total_boxes[:, 5] * bbw,
+                                 total_boxes[:, 1]+total_boxes[:, 6] * bbh,
+                                 total_boxes[:, 2]+total_boxes[:, 7] * bbw,
+                                 total_boxes[:, 3]+total_boxes[:, 8] * bbh,
+                                 total_boxes[:, 4]
+                                 ])
+
+        total_boxes = total_boxes.T
+        total_boxes = self.convert_to_square(total_boxes)
+        total_boxes[:, 0:4] = np.round(total_boxes[:, 0:4])
+
+        #############################################
+        # second stage
+        #############################################
+        input_buf = self.crop_boxes(imgs, total_boxes, owners, 24)
+        output = self.RNet.predict(input_buf)
+
+        # filter the total_boxes with threshold
+        passed = np.where(output[1][:, 1] > self.threshold[1])
+        total_boxes = total_boxes[passed]
+        owners = owners[passed]
+
+        if total_boxes.size == 0:
+            return results
+
+        total_boxes[:, 4] = output[1][passed, 1].reshape((-1,))
+        reg = output[0][passed]
+
+        # nms
+        pick = self.nms_by_owner(total_boxes, owners, 0.7, 'Union')
+        total_boxes = total_boxes[pick]
+        owners = owners[pick]
+        total_boxes = self.calibrate_box(total_boxes, reg[pick])
+        total_boxes = self.convert_to_square(total_boxes)
+        total_boxes[:, 0:4] = np.round(total_boxes[:, 0:4])
+
+        #############################################
+        # third stage
+        #############################################
+        float_imgs = self.float_images(imgs, np.unique(owners))
+        input_buf = self.crop_boxes(float_imgs, total_boxes, owners, 48, np.float32)
+        output = self.ONet.predict(input_buf)
+
+        # filter the total_boxes with threshold
+        passed = np.where(output[2][:, 1] > self.threshold[2])
+        total_boxes = total_boxes[passed]
+        owners = owners[passed]
+
+        if total_boxes.size == 0:
+            return results
+
+        total_boxes[:, 4] = output[2][passed, 1].reshape((-1,))
+        reg = output[1][passed]
+        points = output[0][passed]
+
+        # compute landmark points
+        bbw = total_boxes[:, 2] - total_boxes[:, 0] + 1
+        bbh = total_boxes[:, 3] - total_boxes[:, 1] + 1
+        points[:, 0:5] = np.expand_dims(total_boxes[:, 0], 1) + np.expand_dims(bbw, 1) * points[:, 0:5]
+        points[:, 5:10] = np.expand_dims(total_boxes[:, 1], 1) + np.expand_dims(bbh, 1) * points[:, 5:10]
+
+        # nms
+        total_boxes = self.calibrate_box(total_boxes, reg)
+        pick = self.nms_by_owner(total_boxes, owners, 0.7, 'Min')
+        total_boxes = total_boxes[pick]
+        points = points[pick]
+        owners = owners[pick]
+
+        if self.accurate_landmark:
+            points = self.refine_landmarks(float_imgs, total_boxes, points, owners)
+
+        for i in np.unique(owners):
+            idx = np.where(owners == i)[0]
+            results[i] = (total_boxes[idx], points[idx])
+
+        return results
+
+    def refine_landmarks(self, imgs, total_boxes, points, owners):
+        """
+            extended stage, LNet over patches around each landmark
+        Parameters:
+        ----------
+            imgs: list of numpy arrays
+                input images, float32 as converted for the third stage
+            total_boxes: numpy array, n x 5
+                bboxes after the third stage
+            points: numpy array, n x 10
+                landmarks after the third stage
+            owners: numpy array, n
+                index of the image each box belongs to
+        Returns:
+        -------
+            numpy array, n x 10 refined landmarks
+        """
         num_box = total_boxes.shape[0]
         patchw = np.maximum(total_boxes[:, 2]-total_boxes[:, 0]+1, total_boxes[:, 3]-total_boxes[:, 1]+1)
         patchw = np.round(patchw*0.25)
@@ -364,17 +629,15 @@ class MtcnnDetector(object):
         # make it even
         patchw[np.where(np.mod(patchw,2) == 1)] += 1
 
-        input_buf = np.zeros((num_box, 15, 24, 24), dtype=np.float32)
+        input_buf = get_arena().get('lnet', (num_box, 15, 24, 24))
         for i in range(5):
             x, y = points[:, i], points[:, i+5]
             x, y = np.round(x-0.5*patchw), np.round(y-0.5*patchw)
-            [dy, edy, dx, edx, y, ey, x, ex, tmpw, tmph] = self.pad(np.vstack([x, y, x+patchw-1, y+patchw-1]).T,
-                                                                    width,
-                                                                    height)
-            for j in range(num_box):
-                tmpim = np.zeros((tmpw[j], tmpw[j], 3), dtype=np.float32)
-                tmpim[dy[j]:edy[j]+1, dx[j]:edx[j]+1, :] = img[y[j]:ey[j]+1, x[j]:ex[j]+1, :]
-                input_buf[j, i*3:i*3+3, :, :] = adjust_input(cv2.resize(tmpim, (24, 24)))
+            patches = np.vstack([x, y, x+patchw-1, y+patchw-1]).T.astype(np.int32)
+            for owner in np.unique(owners):
+                idx = np.where(owners == owner)[0]
+                # patch of each landmark goes to its own 3 channels
+                crop_resize(imgs[owner], patches[idx], 24, input_buf[:, i*3:i*3+3], idx, np.float32)
 
         output = self.LNet.predict(input_buf)
 
@@ -392,8 +655,59 @@ class MtcnnDetector(object):
         points = np.hstack([pointx, pointy])
         points = points.astype(np.int32)
 
-        return total_boxes, points
+        return points
+
+    def detect_landmarks(self, img, boxes, refine=False):
+        """
+            landmarks for faces already localized by another detector,
+            boxes are squared, padded and fed straight into ONet
+        Parameters:
+        ----------
+            img: numpy array, bgr order of shape (n, m, 3)
+                input image
+            boxes: numpy array, n x 5 (x1, y1, x2, y2, score)
+                face boxes
+            refine: bool
+                refine landmarks with LNet
+        Retures:
+        -------
+            None or (bboxes, points, keep) same as detect_face,
+            keep holds indexes of input boxes accepted by ONet
+        """
+        if len(boxes) == 0:
+            return None
+
+        total_boxes = self.convert_to_square(np.asarray(boxes, dtype=np.float64)[:, 0:5])
+        total_boxes[:, 0:4] = np.round(total_boxes[:, 0:4])
+        owners = np.zeros(total_boxes.shape[0], dtype=np.int64)
+
+        float_imgs = self.float_images([img], [0])
+        input_buf = self.crop_boxes(float_imgs, total_boxes, owners, 48, np.float32)
+        output = self.ONet.predict(input_buf)
+
+        # filter the total_boxes with threshold
+        keep = np.where(output[2][:, 1] > self.threshold[2])[0]
+        total_boxes = total_boxes[keep]
+
+        if total_boxes.size == 0:
+            return None
 
+        total_boxes[:, 4] = output[2][keep, 1].reshape((-1,))
+        reg = output[1][keep]
+        points = output[0][keep]
+
+        # compute landmark points
+        bbw = total_boxes[:, 2] - total_boxes[:, 0] + 1
+        bbh = total_boxes[:, 3] - total_boxes[:, 1] + 1
+        points[:, 0:5] = np.expand_dims(total_boxes[:, 0], 1) + np.expand_dims(bbw, 1) * points[:, 0:5]
+        points[:, 5:10] = np.expand_dims(total_boxes[:, 1], 1) + np.expand_dims(bbh, 1) * points[:, 5:10]
+
+        total_boxes = self.calibrate_box(total_boxes, reg)
+
+        if refine:
+            points = self.refine_landmarks(float_imgs, total_boxes, points, owners[keep])
+
+        return total_boxes, points, keep
 
     def detect_face_limited(self, img, det_type=2):
         height, width, _ = img.shape
@@ -401,15 +715,8 @@ class MtcnnDetector(object):
           total_boxes = np.array( [ [0.0, 0.0, img.shape[1], img.shape[0], 0.9] ] ,dtype=np.float32)
           num_box = total_boxes.shape[0]
 
-          # pad the bbox
-          [dy, edy, dx, edx, y, ey, x, ex, tmpw, tmph] = self.pad(total_boxes, width, height)
           # (3, 24, 24) is the input shape for RNet
-          input_buf = np.zeros((num_box, 3, 24, 24), dtype=np.float32)
-
-          for i in range(num_box):
-              tmp = np.zeros((tmph[i], tmpw[i], 3), dtype=np.uint8)
-              tmp[dy[i]:edy[i]+1, dx[i]:edx[i]+1, :] = img[y[i]:ey[i]+1, x[i]:ex[i]+1, :]
-              input_buf[i, :, :, :] = adjust_input(cv2.resize(tmp, (24, 24)))
+          input_buf = self.crop_boxes([img], total_boxes, np.zeros(num_box, dtype=np.int32), 24)
 
           output = self.RNet.predict(input_buf)
 
@@ -432,14 +739,9 @@ class MtcnnDetector(object):
         else:
           total_boxes = np.array( [ [0.0, 0.0, img.shape[1], img.shape[0], 0.9] ] ,dtype=np.float32)
         num_box = total_boxes.shape[0]
-        [dy, edy, dx, edx, y, ey, x, ex, tmpw, tmph] = self.pad(total_boxes, width, height)
+        float_imgs = self.float_images([img], [0])
         # (3, 48, 48) is the input shape for ONet
-        input_buf = np.zeros((num_box, 3, 48, 48), dtype=np.float32)
-
-        for i in range(num_box):
-            tmp = np.zeros((tmph[i], tmpw[i], 3), dtype=np.float32)
-            tmp[dy[i]:edy[i]+1, dx[i]:edx[i]+1, :] = img[y[i]:ey[i]+1, x[i]:ex[i]+1, :]
-            input_buf[i, :, :, :] = adjust_input(cv2.resize(tmp, (48, 48)))
+        input_buf = self.crop_boxes(float_imgs, total_boxes, np.zeros(num_box, dtype=np.int32), 48, np.float32)
 
         output = self.ONet.predict(input_buf)
         #print(output[2])
@@ -473,183 +775,89 @@ class MtcnnDetector(object):
         #############################################
         # extended stage
         #############################################
-        num_box = total_boxes.shape[0]
-        patchw = np.maximum(total_boxes[:, 2]-total_boxes[:, 0]+1, total_boxes[:, 3]-total_boxes[:, 1]+1)
-        patchw = np.round(patchw*0.25)
-
-        # make it even
-        patchw[np.where(np.mod(patchw,2) == 1)] += 1
-
-        input_buf = np.zeros((num_box, 15, 24, 24), dtype=np.float32)
-        for i in range(5):
-            x, y = points[:, i], points[:, i+5]
-            x, y = np.round(x-0.5*patchw), np.round(y-0.5*patchw)
-            [dy, edy, dx, edx, y, ey, x, ex, tmpw, tmph] = self.pad(np.vstack([x, y, x+patchw-1, y+patchw-1]).T,
-                                                                    width,
-                                                                    height)
-            for j in range(num_box):
-                tmpim = np.zeros((tmpw[j], tmpw[j], 3), dtype=np.float32)
-                tmpim[dy[j]:edy[j]+1, dx[j]:edx[j]+1, :] = img[y[j]:ey[j]+1, x[j]:ex[j]+1, :]
-                input_buf[j, i*3:i*3+3, :, :] = adjust_input(cv2.resize(tmpim, (24, 24)))
-
-        output = self.LNet.predict(input_buf)
-
-        pointx = np.zeros((num_box, 5))
-        pointy = np.zeros((num_box, 5))
-
-        for k in range(5):
-            # do not make a large movement
-            tmp_index = np.where(np.abs(output[k]-0.5) > 0.35)
-            output[k][tmp_index[0]] = 0.5
-
-            pointx[:, k] = np.round(points[:, k] - 0.5*patchw) + output[k][:, 0]*patchw
-            pointy[:, k] = np.round(points[:, k+5] - 0.5*patchw) + output[k][:, 1]*patchw
-
-        points = np.hstack([pointx, pointy])
-        points = points.astype(np.int32)
+        points = self.refine_landmarks(float_imgs, total_boxes, points, np.zeros(total_boxes.shape[0], dtype=np.int32))
 
         return total_boxes, points
 
-    def list2colmatrix(self, pts_list):
+    def find_tfrom_between_shapes(self, from_shape, to_shape):
         """
-            convert list to column matrix
+            find similarity transforms between shapes, all shapes at once
         Parameters:
         ----------
-            pts_list:
-                input list
+            from_shape: numpy array, n x k x 2
+                points of each shape
+            to_shape: numpy array, n x k x 2 or k x 2
+                target points, k x 2 is shared by all shapes
         Retures:
         -------
-            colMat: 
-
+            tran_m: numpy array, n x 2 x 2
+                scaled rotations
+            tran_b: numpy array, n x 2
+                translations
         """
-        assert len(pts_list) > 0
-        colMat = []
-        for i in range(len(pts_list)):
-            colMat.append(pts_list[i][0])
-            colMat.append(pts_list[i][1])
-        colMat = np.matrix(colMat).transpose()
-        return colMat
+        transforms = similarity_transforms(from_shape, to_shape)
+        return transforms[:, :, :2], transforms[:, :, 2]
 
-    def find_tfrom_between_shapes(self, from_shape, to_shape):
+    def alignment_transforms(self, points, desired_size=256, padding=0):
         """
-            find transform between shapes
+            affine matrices of extract_image_chips: rotation and scale of the similarity
+            transform to the mean face, eye center is moved to (0.5, 0.4) of the chip
         Parameters:
         ----------
-            from_shape: 
-            to_shape: 
+            points: numpy array, n x 10 (x1, x2 ... x5, y1, y2 ..y5)
+            desired_size: default 256
+            padding: default 0
         Retures:
         -------
-            tran_m:
-            tran_b:
-        """
-        assert from_shape.shape[0] == to_shape.shape[0] and from_shape.shape[0] % 2 == 0
-
-        sigma_from = 0.0
-        sigma_to = 0.0
-        cov = np.matrix([[0.0, 0.0], [0.0, 0.0]])
-
-        # compute the mean and cov
-        from_shape_points = from_shape.reshape(from_shape.shape[0]//2, 2)
-        to_shape_points = to_shape.reshape(to_shape.shape[0]//2, 2)
-        mean_from = from_shape_points.mean(axis=0)
-        mean_to = to_shape_points.mean(axis=0)
-
-        for i in range(from_shape_points.shape[0]):
-            temp_dis = np.linalg.norm(from_shape_points[i] - mean_from)
-            sigma_from += temp_dis * temp_dis
-            temp_dis = np.linalg.norm(to_shape_points[i] - mean_to)
-            sigma_to += temp_dis * temp_dis
-            cov += (to_shape_points[i].transpose() - mean_to.transpose()) * (from_shape_points[i] - mean_from)
-
-        sigma_from = sigma_from / to_shape_points.shape[0]
-        sigma_to = sigma_to / to_shape_points.shape[0]
-        cov = cov / to_shape_points.shape[0]
-
-        # compute the affine matrix
-        s = np.matrix([[1.0, 0.0], [0.0, 1.0]])
-        u, d, vt = np.linalg.svd(cov)
-
-        if np.linalg.det(cov) < 0:
-            if d[1] < d[0]:
-                s[1, 1] = -1
-            else:
-                s[0, 0] = -1
-        r = u * s * vt
-        c = 1.0
-        if sigma_from != 0:
-            c = 1.0 / sigma_from * np.trace(np.diag(d) * s)
+            numpy array, n x 2 x 3
+        """
+        points = np.asarray(points, dtype=np.float64).reshape((-1, 2, 5)).transpose((0, 2, 1))
+        padding = max(padding, 0)
+
+        # average positions of face points
+        mean_face_shape = np.array([[0.224152, 0.2119465],
+                                    [0.75610125, 0.2119465],
+                                    [0.490127, 0.628106],
+                                    [0.254149, 0.780233],
+                                    [0.726104, 0.780233]])
+        to_points = (padding + mean_face_shape) / (2 * padding + 1) * desired_size
 
-        tran_b = mean_to.transpose() - c * r * mean_from.transpose()
-        tran_m = c * r
+        tran_m, _ = self.find_tfrom_between_shapes(points, to_points)
 
-        return tran_m, tran_b
+        from_center = (points[:, 0] + points[:, 1]) / 2.0
+        to_center = np.array([desired_size * 0.5, desired_size * 0.4])
 
-    def extract_image_chips(self, img, points, desired_size=256, padding=0):
+        transforms = np.empty((points.shape[0], 2, 3))
+        transforms[:, :, :2] = tran_m
+        transforms[:, :, 2] = to_center - np.einsum('nij,nj->ni', tran_m, from_center)
+        return transforms
+
+    def extract_image_chips(self, img, points, desired_size=256, padding=0, out=None):
         """
-            crop and align face
+            crop and align faces
         Parameters:
         ----------
-            img: numpy array, bgr order of shape (1, 3, n, m)
+            img: numpy array, bgr order of shape (h, w, 3)
                 input image
             points: numpy array, n x 10 (x1, x2 ... x5, y1, y2 ..y5)
             desired_size: default 256
             padding: default 0
+            out: numpy array of shape (n, desired_size, desired_size, 3)
+                preallocated chips of img dtype, allocated when None
         Retures:
         -------
-            crop_imgs: list, n
-                cropped and aligned faces 
-        """
-        crop_imgs = []
-        for p in points:
-            shape  =[]
-            for k in range(len(p)//2):
-                shape.append(p[k])
-                shape.append(p[k+5])
-
-            if padding > 0:
-                padding = padding
-            else:
-                padding = 0
-            # average positions of face points
-            mean_face_shape_x = [0.224152, 0.75610125, 0.490127, 0.254149, 0.726104]
-            mean_face_shape_y = [0.2119465, 0.2119465, 0.628106, 0.780233, 0.780233]
-
-            from_points = []
-            to_points = []
-
-            for i in range(len(shape)//2):
-                x = (padding + mean_face_shape_x[i]) / (2 * padding + 1) * desired_size
-                y = (padding + mean_face_shape_y[i]) / (2 * padding + 1) * desired_size
-                to_points.append([x, y])
-                from_points.append([shape[2*i], shape[2*i+1]])
-
-            # convert the points to Mat
-            from_mat = self.list2colmatrix(from_points)
-            to_mat = self.list2colmatrix(to_points)
-
-            # compute the similar transfrom
-            tran_m, tran_b = self.find_tfrom_between_shapes(from_mat, to_mat)
-
-            probe_vec = np.matrix([1.0, 0.0]).transpose()
-            probe_vec = tran_m * probe_vec
-
-            scale = np.linalg.norm(probe_vec)
-            angle = 180.0 / math.pi * math.atan2(probe_vec[1, 0], probe_vec[0, 0])
-
-            from_center = [(shape[0]+shape[2])/2.0, (shape[1]+shape[3])/2.0]
-            to_center = [0, 0]
-            to_center[1] = desired_size * 0.4
-            to_center[0] = desired_size * 0.5
-
-            ex = to_center[0] - from_center[0]
-            ey = to_center[1] - from_center[1]
-
-            rot_mat = cv2.getRotationMatrix2D((from_center[0], from_center[1]), -1*angle, scale)
-            rot_mat[0][2] += ex
-            rot_mat[1][2] += ey
+            crop_imgs: numpy array, n x desired_size x desired_size x 3
+                cropped and aligned faces
+        """
+        num = len(points)
+        if out is None:
+            out = np.zeros((num, desired_size, desired_size) + img.shape[2:], dtype=img.dtype)
+        if num == 0:
+            return out
 
-            chips = cv2.warpAffine(img, rot_mat, (desired_size, desired_size))
-            crop_imgs.append(chips)
+        transforms = self.alignment_transforms(points, desired_size, padding)
+        for i in range(num):
+            cv2.warpAffine(img, transforms[i], (desired_size, desired_size), dst=out[i])
 
-        return crop_imgs
+        return out
 
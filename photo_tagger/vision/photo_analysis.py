@@ -6,6 +6,10 @@ sys.path.append('vision/SSH/')
 from ssh_detector import SSHDetector
 from vision.mtcnn_detector import MtcnnDetector
 from vision.embedding import Embedding
+from vision.device import get_context
+from vision.helper import transform_points
+from vision.arena import get_arena
+from vision.decode import decode_image, image_scale, photo_size
 import logging
 
 
@@ -15,83 +19,326 @@ class VectorExtractor:
         This class provides functionality for retrieving descriptors for each face in image
     '''
     def __init__(self, recognition_model_path, ssh_model_path,
-                    mtcnn_model_path, scales, detection_threshold):
-        self.extractor = Embedding(recognition_model_path, 0)
-        self.detector = SSHDetector(ssh_model_path, 0)
-        self.mtcnn_detector = MtcnnDetector(mtcnn_model_path)
+                    mtcnn_model_path, scales, detection_threshold, ctx_id=0, mtcnn_workers=1,
+                    landmark_mode='mtcnn', writer=None, device_postprocess=False, coarse_detection=None,
+                    enroll_scales=(480, 640), tiled_detection=None, packed_pyramid=False):
+        '''
+            ctx_id: gpu id to run models on, negative value means cpu
+            mtcnn_workers: number of processes for the first stage of MTCNN
+            landmark_mode: 'mtcnn' runs full MTCNN on a chip around each face,
+                'onet' feeds SSH boxes straight into ONet, 'lnet' also refines them with LNet
+            writer: storage.PhotoWriter persisting downscaled photos, None keeps uploads untouched
+            device_postprocess: select SSH candidates on device and copy only them to host
+            coarse_detection: dict enabling two pass detection, photos are detected at 'scales'
+                first and again at full scale if a face is smaller than 'min_face' pixels at coarse
+                scale, scores below 'uncertain_score', or no face is found and 'rescan_empty' is set
+            enroll_scales: (target_size, max_size) of detection for enrollment selfies
+            tiled_detection: dict enabling tiled detection, photos with long to short side ratio
+                of at least 'min_aspect' or long side of at least 'min_size' pixels are kept
+                up to 'scales' instead of scales and detected on overlapping tiles of 'tile_size'
+            packed_pyramid: run MTCNN first stage once over all pyramid levels packed into a canvas
+        '''
+        self.extractor = Embedding(recognition_model_path, 0, ctx_id)
+        self.detector = SSHDetector(ssh_model_path, 0, ctx_id, device_postprocess=device_postprocess,
+                max_size=scales[1])
+        self.mtcnn_detector = MtcnnDetector(mtcnn_model_path, num_worker=mtcnn_workers,
+                    ctx=get_context(ctx_id), packed_pyramid=packed_pyramid)
         self.scales = scales
         self.detection_threshold = detection_threshold
+        self.landmark_mode = landmark_mode
+        self.writer = writer
+        self.coarse_detection = None
+        if coarse_detection is not None:
+            self.coarse_detection = {'scales': [480, 640], 'min_face': 40,
+                                        'uncertain_score': 0.8, 'rescan_empty': True}
+            self.coarse_detection.update(coarse_detection)
+        self.enroll_scales = enroll_scales
+        self.tiled_detection = None
+        if tiled_detection is not None:
+            self.tiled_detection = {'scales': [2400, 4800], 'min_aspect': 2.0, 'min_size': 6000,
+                                        'tile_size': 640, 'overlap': 160, 'batch': 8}
+            self.tiled_detection.update(tiled_detection)
         
-    def _preprocess(self, img):
-        im_shape = img.shape
-        target_size = self.scales[0]
-        max_size = self.scales[1]
-        im_size_min = np.min(im_shape[0:2])
-        im_size_max = np.max(im_shape[0:2])
-        if im_size_min>target_size or im_size_max>max_size:
-            im_scale = float(target_size) / float(im_size_min)
-            # prevent bigger axis from being more than max_size:
-            if np.round(im_scale * im_size_max) > max_size:
-                im_scale = float(max_size) / float(im_size_max)
+    def close(self):
+        '''
+            stop MTCNN first stage workers
+        '''
+        self.mtcnn_detector.close()
+
+    def _preprocess(self, img, scales=None):
+        if scales is None:
+            scales = self.scales
+        im_scale = image_scale(img.shape[0], img.shape[1], scales[0], scales[1])
+        if im_scale != 1.0:
             img = cv2.resize(img, None, None, fx=im_scale, fy=im_scale)
         return img
 
+    def _needs_tiling(self, height, width):
+        '''
+            panoramas and very large photos by size of the original image
+        '''
+        policy = self.tiled_detection
+        if policy is None:
+            return False
+        return (max(height, width) >= policy['min_aspect'] * min(height, width)
+                    or max(height, width) >= policy['min_size'])
+
+    def _is_tiled(self, img):
+        # only photos kept for tiling exceed inference scales
+        return (self.tiled_detection is not None
+                    and image_scale(img.shape[0], img.shape[1], self.scales[0], self.scales[1]) < 1.0)
+
+    def _detect_tiled(self, img):
+        policy = self.tiled_detection
+        return self.detector.detect_tiled(img, self.detection_threshold,
+                    policy['tile_size'], policy['overlap'], policy['batch'], self.scales[1])
+
     @utils.SingleExec()
-    def _detect(self, image):
-        face_rects = self.detector.detect(image, threshold = self.detection_threshold)
-        return face_rects
+    def _detect_batch(self, images):
+        faces_list = [None] * len(images)
+        for i, img in enumerate(images):
+            if self._is_tiled(img):
+                faces_list[i] = self._detect_tiled(img)
+
+        indices = [i for i, faces in enumerate(faces_list) if faces is None]
+        if len(indices) == 0:
+            return faces_list
+
+        images = [images[i] for i in indices]
+        if self.coarse_detection is None:
+            dets = self.detector.detect_batch(images, threshold = self.detection_threshold)
+        else:
+            dets = self._detect_coarse_to_fine(images)
+        for i, faces in zip(indices, dets):
+            faces_list[i] = faces
+        return faces_list
 
     @utils.SingleExec()
-    def _predict(self, img, landmarks):
-        return self.extractor.get(img, landmarks)
+    def _detect_enrollment(self, image):
+        '''
+            selfie faces are large, detect at enroll_scales and fall back to full scale
+            only if nothing is found. Photos kept for tiling fall back to tiles
+        '''
+        im_scale = image_scale(image.shape[0], image.shape[1], self.enroll_scales[0], self.enroll_scales[1])
+        faces = self.detector.detect(image, threshold = self.detection_threshold, scales=[im_scale])
+        if len(faces) == 0 and im_scale < 1.0:
+            if self._is_tiled(image):
+                faces = self._detect_tiled(image)
+            else:
+                faces = self.detector.detect(image, threshold = self.detection_threshold)
+        return faces
 
-    def retrieve(self, img_path):
-        img = cv2.imread(img_path)
+    def _needs_fine(self, faces, im_scale):
+        '''
+            coarse detections are kept unless a face is small or uncertain at coarse scale
+        '''
+        policy = self.coarse_detection
+        if len(faces) == 0:
+            return policy['rescan_empty']
 
-        img = self._preprocess(img)
+        sizes = np.minimum(faces[:, 2] - faces[:, 0], faces[:, 3] - faces[:, 1]) * im_scale
+        return bool(np.any(sizes < policy['min_face']) or np.any(faces[:, 4] < policy['uncertain_score']))
 
-        cv2.imwrite(img_path, img)
-        
-        print(img.shape)
-        faces = self._detect(img)
-        print("faces: " + str(len(faces)))
+    def _detect_coarse_to_fine(self, images):
+        '''
+            detect photos at coarse scales, only photos the policy rejects are detected
+            again at full scale. Returns detections in coordinates of each photo
+        '''
+        target_size, max_size = self.coarse_detection['scales']
+        groups = {}
+        for i, img in enumerate(images):
+            im_scale = image_scale(img.shape[0], img.shape[1], target_size, max_size)
+            groups.setdefault(im_scale, []).append(i)
 
-        vectors = []
+        faces_list = [None] * len(images)
+        fine = []
+        for im_scale, indices in groups.items():
+            dets = self.detector.detect_batch([images[i] for i in indices],
+                        threshold = self.detection_threshold, scales=[im_scale])
+            for i, faces in zip(indices, dets):
+                # photos already within coarse scales were detected at full scale
+                if im_scale < 1.0 and self._needs_fine(faces, im_scale):
+                    fine.append(i)
+                else:
+                    faces_list[i] = faces
 
+        if len(fine) > 0:
+            dets = self.detector.detect_batch([images[i] for i in fine], threshold = self.detection_threshold)
+            for i, faces in zip(fine, dets):
+                faces_list[i] = faces
+        return faces_list
 
+    @utils.SingleExec()
+    def _predict_batch(self, images, landmarks_lists):
+        '''
+            embed faces of several images in one forward, returns (N, 512) matrix
+        '''
+        num = sum(len(landmarks) for landmarks in landmarks_lists)
+        if num == 0:
+            return np.zeros((0, 512), dtype=np.float32)
+
+        # faces of all images are aligned into one reused blob
+        blob = get_arena().get('blob', (num, 3) + tuple(self.extractor.image_size), np.uint8)
+        start = 0
+        for img, landmarks in zip(images, landmarks_lists):
+            self.extractor.align(img, landmarks, out=blob[start:start + len(landmarks)])
+            start += len(landmarks)
+
+        return self.extractor.forward(blob)
+
+    def _landmarks(self, img, faces):
+        '''
+            five landmarks for each detected face, None for faces rejected by MTCNN
+        '''
+        if self.landmark_mode != 'mtcnn':
+            return self._seeded_landmarks(img, faces)
+
+        chips = []
+        transforms = []
         for face in faces:
             w = face[2] - face[0]
             h = face[3] - face[1]
             wc = int( (face[2]+face[0])/2 )
             hc = int( (face[3]+face[1])/2 )
-            size = int(max(w, h)*1.3)
             scale = 100.0/max(w,h)
             M = [ 
                 [scale, 0, 64-wc*scale],
                 [0, scale, 64-hc*scale],
             ]
             M = np.array(M)
-            IM = cv2.invertAffineTransform(M)
+            transforms.append(cv2.invertAffineTransform(M))
+            chips.append(cv2.warpAffine(img, M, (128, 128)))
+
+        # all chips of the photo go through MTCNN stages together
+        results = self.mtcnn_detector.detect_faces(chips)
 
-            ebox = cv2.warpAffine(img, M, (128, 128))
+        points = []
+        inverse = []
+        keep = []
+        for i, (IM, result) in enumerate(zip(transforms, results)):
+            if result is None:
+                continue
 
-            results = self.mtcnn_detector.detect_face(ebox)
+            bboxes, landmark = result
+            # landmarks are (x1..x5, y1..y5)
+            points.append(np.stack([landmark[0][0:5], landmark[0][5:10]], axis=1))
+            inverse.append(IM)
+            keep.append(i)
 
-            if results is None:
+        landmarks = [None] * len(faces)
+        if len(points) == 0:
+            return landmarks
+
+        # map landmarks back from the chips to the image
+        mapped = transform_points(np.array(inverse), np.array(points, dtype=np.float64))
+        for i, landmark5 in zip(keep, mapped.astype(np.float32)):
+            landmarks[i] = landmark5
+        return landmarks
+
+    def _seeded_landmarks(self, img, faces):
+        landmarks = [None] * len(faces)
+        results = self.mtcnn_detector.detect_landmarks(img, faces, refine=self.landmark_mode == 'lnet')
+        if results is None:
+            return landmarks
+
+        bboxes, points, keep = results
+        points = np.stack([points[:, 0:5], points[:, 5:10]], axis=2).astype(np.float32)
+        for i, landmark5 in zip(keep, points):
+            landmarks[i] = landmark5
+        return landmarks
+
+    def _load(self, img_path, data=None):
+        # large JPEGs are decoded at reduced resolution, resize covers only the remainder.
+        # the JPEG header tells if the photo is tiled, other formats are decoded in full anyway
+        scales = self.scales
+        size = None
+        if self.tiled_detection is not None:
+            size = photo_size(img_path, data)
+            if size is None or self._needs_tiling(size[0], size[1]):
+                scales = self.tiled_detection['scales']
+        img, factor = decode_image(img_path, data, scales[0], scales[1], size)
+
+        if img is None:
+            logging.error('Unable to read image at path: ' + str(img_path))
+            # the upload is only in memory, it is kept where the db expects it
+            if data is not None:
+                self._store(img_path, None, data)
+            return None
+
+        if not self._needs_tiling(img.shape[0] * factor, img.shape[1] * factor):
+            scales = self.scales
+        resized = self._preprocess(img, scales)
+
+        # decoded image stays in memory for inference, storing it is up to the writer thread,
+        # photos already within inference scales are left as uploaded
+        if resized is not img or factor > 1:
+            self._store(img_path, resized, data)
+        elif data is not None:
+            self._store(img_path, None, data)
+        return resized
+
+    def _store(self, img_path, img, data):
+        '''
+            store downscaled img and encoded data through the writer, without a writer
+            only data is written and the upload is left untouched otherwise
+        '''
+        if self.writer is not None:
+            self.writer.put(img_path, img, data)
+        elif data is not None:
+            with open(img_path, 'wb') as file:
+                file.write(data)
+
+    def retrieve(self, img_path, data=None):
+        return self.retrieve_batch([img_path], [data])[0]
+
+    def retrieve_enrollment(self, img_path, data=None):
+        '''
+            descriptor of the largest face on a selfie, empty list if there is no usable face.
+            Only that face is aligned and embedded
+        '''
+        img = self._load(img_path, data)
+        if img is None:
+            return []
+
+        faces = self._detect_enrollment(img)
+        areas = (faces[:, 2] - faces[:, 0]) * (faces[:, 3] - faces[:, 1])
+        # faces come sorted by score, try them by area until MTCNN accepts one
+        for i in np.argsort(-areas, kind='stable'):
+            landmark5 = self._landmarks(img, faces[i:i + 1])[0]
+            if landmark5 is not None:
+                return list(self._predict_batch([img], [[landmark5]]))
+        return []
+
+    def retrieve_batch(self, img_paths, datas=None):
+        '''
+            retrieve descriptors for a batch of photos, returns list of vectors for each photo.
+            datas holds encoded photos already in memory, None entries are read from img_paths
+        '''
+        if datas is None:
+            datas = [None] * len(img_paths)
+        images = [self._load(img_path, data) for img_path, data in zip(img_paths, datas)]
+
+        # photos of the batch are detected in one forward, landmarks for every photo,
+        # faces of the whole batch are embedded together
+        faces_list = iter(self._detect_batch([img for img in images if img is not None]))
+        landmarks_lists = []
+        for img in images:
+            landmarks_list = []
+            landmarks_lists.append(landmarks_list)
+            if img is None:
                 continue
 
-            bboxes, landmark = results
+            faces = next(faces_list)
 
-            landmark5 = np.zeros( (5,2) , dtype=np.float32 )
+            landmarks_list.extend(landmark5 for landmark5 in self._landmarks(img, faces) if landmark5 is not None)
 
-            for l in range(5):
-                point = np.ones( (3,), dtype=np.float32)
-                point[0:2] = [landmark[0][l], landmark[0][l+5]]
-                point = np.dot(IM, point)
-                landmark5[l] = point[0:2]
+        feats = self._predict_batch(images, landmarks_lists)
 
-            feat = self._predict(img, landmark5)
-            vectors.append(feat)
+        vectors = []
+        start = 0
+        for landmarks_list in landmarks_lists:
+            vectors.append(list(feats[start:start + len(landmarks_list)]))
+            start += len(landmarks_list)
 
         return vectors
 
@@ -1,8 +1,12 @@
 import pickle
-from multiprocessing import Queue, Process
+import multiprocessing
+from multiprocessing import Queue
+import settings
+from vision import device
+device.configure_cpu(getattr(settings, 'cpu_threads', 0))
 from vision.photo_analysis import VectorExtractor
 from db import meta_db, vector_db
-import settings
+from storage import PhotoWriter
 
 import logging
 import uuid
@@ -10,6 +14,9 @@ import time
 import os
 import threading
 import glob
+import io
+import atexit
+from queue import Empty
 
 import telegram
 from telegram.utils import request
@@ -41,6 +48,88 @@ class MQBot(telegram.bot.Bot):
         OPTIONAL arguments'''
         return super(MQBot, self).send_message(*args, **kwargs)
 
+def drain_batch(task_queue, max_size, max_wait):
+    '''
+        Block until the first task arrives, then keep collecting tasks
+        until the batch is full or max_wait seconds have passed.
+        None stops the worker, nothing is collected after it
+    '''
+    batch = [task_queue.get()]
+    deadline = time.time() + max_wait
+    while len(batch) < max_size and batch[-1] is not None:
+        timeout = deadline - time.time()
+        if timeout <= 0:
+            break
+        try:
+            batch.append(task_queue.get(timeout=timeout))
+        except Empty:
+            break
+
+    return batch
+
+def vision_loop(task_queue, done_queue, in_progress=None):
+    '''
+        Load VectorExtractor and serve tasks forever.
+        in_progress (shared array) holds ids of photos of the current batch, -1 marks free slot
+    '''
+    recognition_model_path = settings.recognition_model_path
+    ssh_model_path = settings.ssh_model_path
+    mtcnn_model_path = settings.mtcnn_model_path
+    scales = settings.scales
+    detection_threshold = settings.detection_threshold
+    batch_size = getattr(settings, 'vision_batch_size', 1)
+    batch_wait = getattr(settings, 'vision_batch_wait', 0.05)
+    ctx_id = getattr(settings, 'ctx_id', 0)
+    mtcnn_workers = getattr(settings, 'mtcnn_workers', 1)
+    landmark_mode = getattr(settings, 'landmark_mode', 'mtcnn')
+    writer = PhotoWriter(**getattr(settings, 'photo_storage', {}))
+    device_postprocess = getattr(settings, 'ssh_device_postprocess', False)
+    coarse_detection = getattr(settings, 'coarse_detection', None)
+    enroll_scales = getattr(settings, 'enrollment_scales', (480, 640))
+    tiled_detection = getattr(settings, 'tiled_detection', None)
+    packed_pyramid = getattr(settings, 'mtcnn_packed_pyramid', False)
+    extractor = VectorExtractor(recognition_model_path, ssh_model_path,
+                mtcnn_model_path, scales, detection_threshold, ctx_id=ctx_id, mtcnn_workers=mtcnn_workers,
+                landmark_mode=landmark_mode, writer=writer, device_postprocess=device_postprocess,
+                coarse_detection=coarse_detection, enroll_scales=enroll_scales,
+                tiled_detection=tiled_detection, packed_pyramid=packed_pyramid)
+
+    while True:
+        tasks = drain_batch(task_queue, batch_size, batch_wait)
+        stop = tasks[-1] is None
+        tasks = [task for task in tasks if task is not None]
+        if in_progress is not None:
+            for i, (photo_id, _, _, _) in enumerate(tasks):
+                in_progress[i] = photo_id
+
+        # selfies of users without a vector only need their largest face
+        results = []
+        for photo_id, file_path, data, enroll in tasks:
+            if enroll:
+                results.append((photo_id, extractor.retrieve_enrollment(file_path, data)))
+
+        batch = [task for task in tasks if not task[3]]
+        if len(batch) > 0:
+            vectors_list = extractor.retrieve_batch([file_path for _, file_path, _, _ in batch],
+                                                    [data for _, _, data, _ in batch])
+            results.extend((photo_id, vectors) for (photo_id, _, _, _), vectors in zip(batch, vectors_list))
+
+        # photos are sent from disk once their result is in, writes of the batch finish first
+        writer.flush()
+        for result in results:
+            done_queue.put(result)
+
+        if in_progress is not None:
+            for i in range(len(in_progress)):
+                in_progress[i] = -1
+
+        if stop:
+            break
+
+    # photos still queued for storage are written before the process exits
+    writer.close()
+    extractor.close()
+
 class VisionWorker:
     def __init__(self):
         self.task_queue = Queue()
@@ -50,26 +139,122 @@ class VisionWorker:
         self.thread.start()
 
     def work(self, task_queue, done_queue):
-        recognition_model_path = settings.recognition_model_path
-        ssh_model_path = settings.ssh_model_path
-        mtcnn_model_path = settings.mtcnn_model_path
-        scales = settings.scales
-        detection_threshold = settings.detection_threshold
-        extractor = VectorExtractor(recognition_model_path, ssh_model_path,
-                    mtcnn_model_path, scales, detection_threshold)
+        vision_loop(task_queue, done_queue)
 
-        while True:
-            photo_id, file_path = task_queue.get()
+    def put_task(self, photo_id, file_path, data=None, enroll=False):
+        self.task_queue.put((photo_id, file_path, data, enroll))
 
-            vectors = extractor.retrieve(file_path)
-            
-            self.done_queue.put((photo_id, vectors))
+    def get_done_task(self):
+        return self.done_queue.get()
 
-    def put_task(self, photo_id, file_path):
-        self.task_queue.put((photo_id, file_path))
+class VisionPool:
+    '''
+        Pool of vision processes, each process loads its own VectorExtractor.
+        Crashed processes are restarted and their photos are requeued, a photo
+        reported twice by a requeue is delivered once
+    '''
+    def __init__(self, num_workers):
+        # spawned rather than forked from a process running mxnet threads, and not daemonic
+        # since MTCNN starts first stage workers of its own
+        self.ctx = multiprocessing.get_context('spawn')
+        self.task_queue = self.ctx.Queue()
+        self.done_queue = self.ctx.Queue()
+        self.max_retries = getattr(settings, 'vision_max_retries', 1)
+        self.health_interval = getattr(settings, 'vision_health_interval', 1.0)
+        batch_size = getattr(settings, 'vision_batch_size', 1)
+
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.retries = {}
+        self.in_progress = [self.ctx.Array('i', [-1] * batch_size) for _ in range(num_workers)]
+        self.closing = False
+        self.processes = [None] * num_workers
+        for idx in range(num_workers):
+            self.start_process(idx)
+
+        self.monitor = threading.Thread(target=self.watch)
+        self.monitor.daemon = True
+        self.monitor.start()
+        # non daemonic processes are joined at exit, they have to be stopped first
+        atexit.register(self.close)
+
+    def start_process(self, idx):
+        for i in range(len(self.in_progress[idx])):
+            self.in_progress[idx][i] = -1
+
+        process = self.ctx.Process(target=vision_loop, args=(self.task_queue, self.done_queue, self.in_progress[idx]))
+        process.start()
+        self.processes[idx] = process
+        logging.info('vision process ' + str(idx) + ' started pid: ' + str(process.pid))
+
+    def watch(self):
+        while True:
+            time.sleep(self.health_interval)
+            for idx, process in enumerate(self.processes):
+                if process.is_alive():
+                    continue
+
+                # processes stopped by close are not restarted
+                with self.lock:
+                    if self.closing:
+                        return
+
+                logging.error('vision process ' + str(idx) + ' died with exit code: ' + str(process.exitcode))
+                lost = [photo_id for photo_id in self.in_progress[idx] if photo_id != -1]
+                self.start_process(idx)
+                for photo_id in lost:
+                    self.retry(photo_id)
+
+    def retry(self, photo_id):
+        with self.lock:
+            task = self.pending.get(photo_id)
+            if task is None:
+                return
+
+            retries = self.retries.get(photo_id, 0)
+            if retries < self.max_retries:
+                self.retries[photo_id] = retries + 1
+                self.task_queue.put(task)
+                return
+
+        logging.error('giving up on photo_id: ' + str(photo_id))
+        self.done_queue.put((photo_id, []))
+
+    def put_task(self, photo_id, file_path, data=None, enroll=False):
+        task = (photo_id, file_path, data, enroll)
+        with self.lock:
+            self.pending[photo_id] = task
+        self.task_queue.put(task)
 
     def get_done_task(self):
-        return self.done_queue.get()
+        while True:
+            photo_id, vectors = self.done_queue.get()
+            with self.lock:
+                # photo requeued after its result was already posted
+                if photo_id not in self.pending:
+                    logging.warning('dropping duplicate result of photo_id: ' + str(photo_id))
+                    continue
+                self.pending.pop(photo_id)
+                self.retries.pop(photo_id, None)
+            return photo_id, vectors
+
+    def close(self, timeout=10.0):
+        '''
+            stop vision processes, processes still busy after timeout are terminated
+        '''
+        with self.lock:
+            if self.closing:
+                return
+            self.closing = True
+
+        for _ in self.processes:
+            self.task_queue.put(None)
+        deadline = time.time() + timeout
+        for process in self.processes:
+            process.join(max(deadline - time.time(), 0))
+            if process.is_alive():
+                process.terminate()
+                process.join()
 
 class TelegramBot:
     """
@@ -87,6 +272,7 @@ class TelegramBot:
         dispatcher = self.updater.dispatcher
 
         distributor.set_frontend(self)
+        in_memory_download = getattr(settings, 'in_memory_download', False)
 
         def start(bot, update):
             bot.send_message(chat_id=update.message.chat_id, text=settings.texts['hello'])
@@ -99,9 +285,17 @@ class TelegramBot:
             file_id = update.message.photo[-1]
             newFile = bot.get_file(file_id)
             unique_str = photo_storage_path + str(uuid.uuid4()) + '.jpg'
-            newFile.download(unique_str)
+            data = None
+            if in_memory_download:
+                # photo is decoded from memory, vision worker stores it at unique_str later
+                buffer = io.BytesIO()
+                newFile.download(out=buffer)
+                data = buffer.getvalue()
+            else:
+                newFile.download(unique_str)
             distributor.photo_handler(update.message.chat_id, unique_str,
-                [str(update.message.from_user.username), update.message.from_user.first_name, str(update.message.from_user.first_name)])
+                [str(update.message.from_user.username), update.message.from_user.first_name, str(update.message.from_user.first_name)],
+                data)
 
         self.distributor = distributor
 
@@ -160,8 +354,14 @@ class Distributor:
         self.faces_db.load(faces_db_path)
         self.photo_db = vector_db.FaissEngine()
         self.photo_db.load(photo_db_path)
-        self.vision_worker = VisionWorker()
+        num_workers = getattr(settings, 'vision_workers', 0)
+        if num_workers > 0:
+            self.vision_worker = VisionPool(num_workers)
+        else:
+            self.vision_worker = VisionWorker()
         self.last_save = time.time()
+        # encoded photos of tasks sent as enrollment by photo_id, kept to run them again
+        self.enrollments = {}
         self.write_worker = threading.Thread(target=self.work, args=(self.vision_worker, ))
         self.write_worker.start()
         
@@ -169,7 +369,7 @@ class Distributor:
     def set_frontend(self, frontend):
         self.frontend = frontend
 
-    def photo_handler(self, chat_id, file_path, username_firstname):
+    def photo_handler(self, chat_id, file_path, username_firstname, data=None):
         user_id = None
 
         if self.db.get_user(chat_id) == -1:
@@ -184,7 +384,11 @@ class Distributor:
 
         photo_id = self.db.new_photo(user_id, file_path)
 
-        self.vision_worker.put_task(photo_id, file_path)
+        # users without a vector send selfies, only the largest face is needed
+        enroll = self.db.get_vector(user_id) == -1
+        if enroll:
+            self.enrollments[photo_id] = data
+        self.vision_worker.put_task(photo_id, file_path, data, enroll)
 
     def send_updates(self, user_id, vector):
         indexes = self.photo_db.range_search(vector, settings.strong_verification_threshold)
@@ -222,7 +426,14 @@ class Distributor:
             photo_id, vectors = vision_worker.get_done_task()
             user_id = self.db.get_sender(photo_id)
             chat_id = self.db.get_chat(user_id)
+            enrollment = photo_id in self.enrollments
+            data = self.enrollments.pop(photo_id, None)
 
+            # another photo of the user enrolled first, this one holds only its largest face
+            # and is processed again as a regular photo
+            if enrollment and self.db.get_vector(user_id) != -1:
+                vision_worker.put_task(photo_id, self.db.get_photo_path(photo_id), data)
+                continue
 
             if self.db.get_vector(user_id) == -1:
                 if len(vectors) == 0:
@@ -234,7 +445,7 @@ class Distributor:
                     self.frontend.send_message(chat_id, settings.texts['auth_failed'])
                     break
 
-                vector_id = self.faces_db.add(vectors[0]) # assuming faces sorted by area on photo
+                vector_id = self.faces_db.add(vectors[0]) # largest face of enrollment photo
                 self.db.set_vector(user_id, vector_id)
                 self.frontend.send_message(chat_id, settings.texts['accepted_selfie'])
 
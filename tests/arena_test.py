@@ -0,0 +1,220 @@
+import math
+import os
+import sys
+import tracemalloc
+from unittest import mock
+
+import numpy as np
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'photo_tagger')
+sys.path.append(root)
+sys.path.append(os.path.join(root, 'vision', 'SSH'))
+
+from vision.arena import BufferArena, get_arena, normalize_planar
+from vision.helper import adjust_input
+
+SSH_MEANS = np.array([123.68, 116.779, 103.939], dtype=np.float32).reshape((3, 1, 1))
+
+
+def former_adjust_input(in_data):
+    '''
+        former helper.adjust_input, a fresh array for every step
+    '''
+    out_data = in_data.astype(np.float32).transpose((2, 0, 1))
+    out_data = np.expand_dims(out_data, 0)
+    return (out_data - 127.5) * 0.0078125
+
+
+class StubOutput(object):
+    def __init__(self, array):
+        self.array = array
+
+    def asnumpy(self):
+        return self.array
+
+
+class StubModule(object):
+    '''
+        mx.mod.Module of SSH, every stride has one confident anchor per image.
+        Outputs are allocated when binding as the executor memory of a real module
+    '''
+    def __init__(self, symbol=None, context=None, label_names=None):
+        self.outputs = []
+
+    def bind(self, data_shapes, for_training=False, shared_module=None):
+        num, _, height, width = data_shapes[0][1]
+        for stride in (32, 16, 8):
+            feat_shape = (int(math.ceil(height / float(stride))), int(math.ceil(width / float(stride))))
+            # two anchors per stride, background scores first
+            scores = np.zeros((num, 4) + feat_shape, dtype=np.float32)
+            scores[:, 2, 1, 1] = 0.9
+            deltas = np.zeros((num, 8) + feat_shape, dtype=np.float32)
+            self.outputs += [StubOutput(scores), StubOutput(deltas)]
+
+    def set_params(self, arg_params, aux_params):
+        pass
+
+    def forward(self, data_batch, is_train=False):
+        pass
+
+    def get_outputs(self):
+        return self.outputs
+
+
+class StubNet(object):
+    '''
+        mx.model.FeedForward of MTCNN, every candidate passes its stage.
+        Outputs are kept per input shape as the executors of a real net
+    '''
+    def __init__(self, name):
+        self.name = name
+        self.outputs = {}
+
+    def predict(self, data):
+        outputs = self.outputs.get(data.shape)
+        if outputs is None:
+            outputs = self.outputs[data.shape] = self._outputs(data.shape)
+        return outputs
+
+    def _outputs(self, shape):
+        num = shape[0]
+        if self.name == 'det1':
+            feat_shape = ((shape[2] - 12) // 2 + 1, (shape[3] - 12) // 2 + 1)
+            prob = np.zeros((num, 2) + feat_shape, dtype=np.float32)
+            prob[:, 1, 0, 0] = 0.9
+            return [np.zeros((num, 4) + feat_shape, dtype=np.float32), prob]
+
+        prob = np.tile(np.array([0.1, 0.9], dtype=np.float32), (num, 1))
+        if self.name == 'det2':
+            return [np.zeros((num, 4), dtype=np.float32), prob]
+        if self.name == 'det3':
+            return [np.full((num, 10), 0.5, dtype=np.float32), np.zeros((num, 4), dtype=np.float32), prob]
+        return [np.full((num, 2), 0.5, dtype=np.float32) for _ in range(5)]
+
+
+def stub_nets():
+    '''
+        patches loading of mxnet models with the stubs
+    '''
+    import mxnet as mx
+    return [mock.patch.object(mx.model, 'load_checkpoint', lambda prefix, epoch: (None, {}, {})),
+            mock.patch.object(mx.mod, 'Module', StubModule),
+            mock.patch.object(mx.model.FeedForward, 'load',
+                              lambda prefix, epoch, ctx=None: StubNet(os.path.basename(prefix)))]
+
+
+def traced_calls(func):
+    '''
+        (retained, peak) bytes of a warm up call and of a second call,
+        with the arena blocks after each of them
+    '''
+    calls = []
+    for _ in range(2):
+        tracemalloc.start()
+        func()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        calls.append((current, peak, dict(get_arena().blocks)))
+    return calls
+
+
+def assert_steady_state(name, calls, input_name):
+    (warm_current, warm_peak, warm_blocks), (current, peak, blocks) = calls
+    print('%-6s warm up: retained %d bytes, peak %d bytes' % (name, warm_current, warm_peak))
+    print('%-6s second: retained %d bytes, peak %d bytes, arena holds %d bytes'
+          % (name, current, peak, get_arena().nbytes))
+
+    # the second call takes the blocks of the warm up call and keeps nothing
+    assert blocks.keys() == warm_blocks.keys()
+    assert all(blocks[key] is warm_blocks[key] for key in blocks)
+    assert current < 64 * 1024
+
+    # network input of the second call is not allocated again
+    input_bytes = sum(block.nbytes for (block_name, _), block in blocks.items() if block_name == input_name)
+    assert input_bytes > 0
+    assert peak < warm_peak - input_bytes
+
+
+def check_views():
+    arena = BufferArena()
+    a = arena.get('x', (2, 3, 4))
+    assert a.shape == (2, 3, 4) and a.dtype == np.float32 and a.flags['C_CONTIGUOUS']
+
+    # smaller requests are views into the same block, larger ones grow it
+    b = arena.get('x', (1, 3, 4))
+    assert np.shares_memory(a, b)
+    c = arena.get('x', (4, 3, 4))
+    assert not np.shares_memory(a, c)
+    assert arena.nbytes == c.nbytes
+
+    # names and dtypes do not share blocks
+    assert not np.shares_memory(arena.get('y', (2, 3, 4)), arena.get('x', (2, 3, 4)))
+    assert arena.get('x', (2, 3, 4), np.uint8).dtype == np.uint8
+    assert arena.zeros('x', (2, 2)).sum() == 0
+
+
+def check_normalize():
+    rng = np.random.RandomState(0)
+    img = rng.randint(0, 256, (37, 53, 3)).astype(np.uint8)
+    np.testing.assert_array_equal(adjust_input(img), former_adjust_input(img))
+
+    # without out every call returns its own array
+    assert not np.shares_memory(adjust_input(img), adjust_input(img))
+
+    out = np.empty((3, 37, 53), dtype=np.float32)
+    normalize_planar(img, out, SSH_MEANS, reverse=True)
+    np.testing.assert_allclose(out, img.transpose((2, 0, 1))[::-1] - SSH_MEANS, atol=1e-5)
+
+
+def check_ssh_steady_state():
+    from ssh_detector import SSHDetector
+
+    rng = np.random.RandomState(0)
+    images = [rng.randint(0, 256, (h, w, 3)).astype(np.uint8) for h, w in [(480, 640), (360, 480), (640, 427)]]
+
+    patches = stub_nets()
+    for patch in patches:
+        patch.start()
+    try:
+        detector = SSHDetector('stub', 0, ctx_id=-1, max_size=960)
+        get_arena().clear()
+        calls = traced_calls(lambda: detector.detect_batch(images))
+    finally:
+        for patch in patches:
+            patch.stop()
+
+    assert_steady_state('ssh', calls, 'ssh')
+
+
+def check_mtcnn_steady_state():
+    from vision.mtcnn_detector import MtcnnDetector
+
+    rng = np.random.RandomState(0)
+    # face chips of one photo, two shapes
+    images = [rng.randint(0, 256, (h, w, 3)).astype(np.uint8) for h, w in [(160, 128)] * 3 + [(128, 128)]]
+
+    patches = stub_nets()
+    for patch in patches:
+        patch.start()
+    try:
+        detector = MtcnnDetector('stub', minsize=20, accurate_landmark=True)
+        get_arena().clear()
+        calls = traced_calls(lambda: detector.detect_faces(images))
+    finally:
+        for patch in patches:
+            patch.stop()
+
+    assert_steady_state('mtcnn', calls, 'pnet')
+
+
+if __name__ == '__main__':
+    check_views()
+    check_normalize()
+    try:
+        import mxnet
+    except ImportError:
+        print('mxnet is not installed, detector checks are skipped')
+    else:
+        check_ssh_steady_state()
+        check_mtcnn_steady_state()
+    print('ok')
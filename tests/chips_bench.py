@@ -0,0 +1,105 @@
+import argparse
+import math
+import os
+import sys
+import time
+
+import numpy as np
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'photo_tagger')
+sys.path.append(root)
+sys.path.append(os.path.join(root, 'vision', 'SSH'))
+
+
+def loop_extract_image_chips(img, points, desired_size=256, padding=0):
+    '''
+        former MtcnnDetector.extract_image_chips, np.matrix transform per face
+    '''
+    import cv2
+
+    mean_face_shape_x = [0.224152, 0.75610125, 0.490127, 0.254149, 0.726104]
+    mean_face_shape_y = [0.2119465, 0.2119465, 0.628106, 0.780233, 0.780233]
+    crop_imgs = []
+    for p in points:
+        from_points = np.array([[p[k], p[k + 5]] for k in range(5)])
+        to_points = np.array([[(padding + mean_face_shape_x[i]) / (2 * padding + 1) * desired_size,
+                               (padding + mean_face_shape_y[i]) / (2 * padding + 1) * desired_size] for i in range(5)])
+
+        mean_from, mean_to = from_points.mean(axis=0), to_points.mean(axis=0)
+        sigma_from, cov = 0.0, np.matrix([[0.0, 0.0], [0.0, 0.0]])
+        for i in range(5):
+            sigma_from += np.linalg.norm(from_points[i] - mean_from) ** 2
+            cov += np.matrix(to_points[i] - mean_to).transpose() * np.matrix(from_points[i] - mean_from)
+        sigma_from, cov = sigma_from / 5, cov / 5
+
+        s = np.matrix([[1.0, 0.0], [0.0, 1.0]])
+        u, d, vt = np.linalg.svd(cov)
+        if np.linalg.det(cov) < 0:
+            if d[1] < d[0]:
+                s[1, 1] = -1
+            else:
+                s[0, 0] = -1
+        tran_m = 1.0 / sigma_from * np.trace(np.diag(d) * s) * u * s * vt
+
+        probe_vec = tran_m * np.matrix([1.0, 0.0]).transpose()
+        scale = np.linalg.norm(probe_vec)
+        angle = 180.0 / math.pi * math.atan2(probe_vec[1, 0], probe_vec[0, 0])
+
+        from_center = [(p[0] + p[1]) / 2.0, (p[5] + p[6]) / 2.0]
+        rot_mat = cv2.getRotationMatrix2D((from_center[0], from_center[1]), -1 * angle, scale)
+        rot_mat[0][2] += desired_size * 0.5 - from_center[0]
+        rot_mat[1][2] += desired_size * 0.4 - from_center[1]
+        crop_imgs.append(cv2.warpAffine(img, rot_mat, (desired_size, desired_size)))
+    return crop_imgs
+
+
+def make_points(num, height, width, rng):
+    '''
+        five point landmarks of rotated and scaled faces, n x 10 (x1 .. x5, y1 .. y5)
+    '''
+    base = np.array([[30, 70, 50, 35, 65], [40, 40, 60, 80, 80]], dtype=np.float64)
+    base -= base.mean(axis=1, keepdims=True)
+    angle = rng.uniform(-0.8, 0.8, num)
+    scale = rng.uniform(0.5, 3.0, num)
+    rot = np.stack([np.cos(angle), -np.sin(angle), np.sin(angle), np.cos(angle)], axis=1).reshape((num, 2, 2))
+    points = np.einsum('nij,jk->nik', rot, base) * scale[:, np.newaxis, np.newaxis]
+    points += rng.uniform([[50], [50]], [[width - 50], [height - 50]], (num, 2, 1))
+    points += rng.normal(0, 2, points.shape)
+    return points.reshape((num, 10))
+
+
+def timed(func, repeat):
+    start = time.time()
+    for _ in range(repeat):
+        result = func()
+    return (time.time() - start) / repeat, result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='batched chip extraction against the former per face loop')
+    parser.add_argument('--faces', type=int, nargs='+', default=[1, 10, 100, 1000])
+    parser.add_argument('--size', type=int, default=256)
+    parser.add_argument('--padding', type=float, default=0.0)
+    parser.add_argument('--mtcnn-model', default=os.path.join(root, 'vision/mtcnn-model/'))
+    args = parser.parse_args()
+
+    import cv2
+    from vision.mtcnn_detector import MtcnnDetector
+
+    detector = MtcnnDetector(args.mtcnn_model, num_worker=1)
+    rng = np.random.RandomState(0)
+    img = cv2.GaussianBlur((rng.rand(1080, 1920, 3) * 255).astype(np.uint8), (5, 5), 2)
+
+    print('%-8s %12s %12s %12s %10s' % ('faces', 'loop', 'batched', 'preallocated', 'max diff'))
+    for num in args.faces:
+        points = make_points(num, img.shape[0], img.shape[1], rng)
+        out = np.empty((num, args.size, args.size, 3), dtype=np.uint8)
+        repeat = max(1, 100 // num)
+
+        loop_seconds, reference = timed(lambda: loop_extract_image_chips(img, points, args.size, args.padding), repeat)
+        batch_seconds, chips = timed(lambda: detector.extract_image_chips(img, points, args.size, args.padding), repeat)
+        out_seconds, _ = timed(lambda: detector.extract_image_chips(img, points, args.size, args.padding, out=out), repeat)
+
+        diff = np.abs(np.array(reference, dtype=np.int32) - chips).max()
+        print('%-8d %9.2f ms %9.2f ms %9.2f ms %10d' % (num, 1000.0 * loop_seconds, 1000.0 * batch_seconds,
+                                                         1000.0 * out_seconds, diff))
@@ -0,0 +1,96 @@
+import argparse
+import glob
+import os
+import sys
+import time
+
+import numpy as np
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'photo_tagger')
+sys.path.append(root)
+sys.path.append(os.path.join(root, 'vision', 'SSH'))
+
+
+def iou(box, boxes):
+    x1 = np.maximum(box[0], boxes[:, 0])
+    y1 = np.maximum(box[1], boxes[:, 1])
+    x2 = np.minimum(box[2], boxes[:, 2])
+    y2 = np.minimum(box[3], boxes[:, 3])
+    inter = np.maximum(0, x2 - x1 + 1) * np.maximum(0, y2 - y1 + 1)
+    area = (box[2] - box[0] + 1) * (box[3] - box[1] + 1)
+    areas = (boxes[:, 2] - boxes[:, 0] + 1) * (boxes[:, 3] - boxes[:, 1] + 1)
+    return inter / (area + areas - inter)
+
+
+def matched(reference, faces, thr=0.5):
+    '''
+        number of reference faces overlapped by some face with IoU above thr
+    '''
+    if len(reference) == 0 or len(faces) == 0:
+        return 0
+    return sum(iou(box, faces).max() >= thr for box in reference)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='coarse-to-fine detection against full scale detection')
+    parser.add_argument('images', help='glob of test images')
+    parser.add_argument('--ctx-id', type=int, default=0, help='gpu id, negative for cpu')
+    parser.add_argument('--coarse-scales', type=int, nargs=2, default=[480, 640])
+    parser.add_argument('--min-face', type=float, default=40)
+    parser.add_argument('--uncertain-score', type=float, default=0.8)
+    parser.add_argument('--no-rescan-empty', action='store_true')
+    parser.add_argument('--recognition-model', default=os.path.join(root, 'vision/models/model-r100-ii/model'))
+    parser.add_argument('--ssh-model', default=os.path.join(root, 'vision/SSH/model/e2ef'))
+    parser.add_argument('--mtcnn-model', default=os.path.join(root, 'vision/mtcnn-model/'))
+    args = parser.parse_args()
+
+    from vision.photo_analysis import VectorExtractor
+
+    paths = sorted(glob.glob(args.images))
+    policy = {'scales': args.coarse_scales, 'min_face': args.min_face,
+              'uncertain_score': args.uncertain_score, 'rescan_empty': not args.no_rescan_empty}
+    extractor = VectorExtractor(args.recognition_model, args.ssh_model, args.mtcnn_model,
+                [1200, 1600], 0.5, args.ctx_id, coarse_detection=policy)
+
+    # full scale passes of the two pass mode are counted by their default scales
+    detect_batch = extractor.detector.detect_batch
+    rescans = [0]
+
+    def counting_detect_batch(images, threshold=0.5, scales=[1.0]):
+        if scales == [1.0]:
+            rescans[0] += len(images)
+        return detect_batch(images, threshold, scales)
+    extractor.detector.detect_batch = counting_detect_batch
+
+    seconds = {'full': 0.0, 'two-pass': 0.0}
+    num_reference = 0
+    num_found = 0
+    num_recalled = 0
+    num_rescanned = 0
+    for path in paths:
+        img = extractor._load(path)
+        # first calls warm up executors for the buckets of this photo
+        extractor.detector.detect(img, threshold=0.5)
+        extractor._detect_coarse_to_fine([img])
+
+        start = time.time()
+        reference = detect_batch([img], threshold=0.5)[0]
+        seconds['full'] += time.time() - start
+
+        before = rescans[0]
+        start = time.time()
+        faces = extractor._detect_coarse_to_fine([img])[0]
+        seconds['two-pass'] += time.time() - start
+        num_rescanned += rescans[0] - before
+
+        num_reference += len(reference)
+        num_found += len(faces)
+        num_recalled += matched(reference, faces)
+
+    print('photos:', len(paths), 'policy:', policy)
+    print('%-9s %10s' % ('mode', 'ms/photo'))
+    for mode in ['full', 'two-pass']:
+        print('%-9s %10.2f' % (mode, 1000.0 * seconds[mode] / max(len(paths), 1)))
+    print('rescanned photos: %d (%.1f%%)' % (num_rescanned, 100.0 * num_rescanned / max(len(paths), 1)))
+    print('faces full: %d two-pass: %d recall: %.4f' % (num_reference, num_found,
+          float(num_recalled) / max(num_reference, 1)))
@@ -0,0 +1,49 @@
+import argparse
+import glob
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'photo_tagger')
+sys.path.append(root)
+
+
+def run(mode, paths, scales, result):
+    import cv2
+    from vision.decode import decode_image, image_scale
+
+    start = time.time()
+    for path in paths:
+        if mode == 'full':
+            img = cv2.imread(path)
+        else:
+            img, _ = decode_image(path, None, scales[0], scales[1])
+        im_scale = image_scale(img.shape[0], img.shape[1], scales[0], scales[1])
+        if im_scale != 1.0:
+            img = cv2.resize(img, None, None, fx=im_scale, fy=im_scale)
+    seconds = time.time() - start
+
+    # ru_maxrss is in kilobytes on linux
+    result.put((seconds, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='full against reduced resolution JPEG decode')
+    parser.add_argument('images', help='glob of JPEG photos')
+    parser.add_argument('--scales', type=int, nargs=2, default=[1200, 1600])
+    args = parser.parse_args()
+
+    paths = sorted(glob.glob(args.images))
+    # every mode runs in a fresh process so peak RSS is not shared
+    ctx = multiprocessing.get_context('spawn')
+    print('photos:', len(paths), 'scales:', args.scales)
+    print('%-8s %10s %10s %12s' % ('mode', 'seconds', 'ms/photo', 'peak RSS MB'))
+    for mode in ['full', 'reduced']:
+        result = ctx.Queue()
+        process = ctx.Process(target=run, args=(mode, paths, args.scales, result))
+        process.start()
+        seconds, rss = result.get()
+        process.join()
+        print('%-8s %10.3f %10.2f %12.1f' % (mode, seconds, 1000.0 * seconds / max(len(paths), 1), rss))
@@ -0,0 +1,69 @@
+import argparse
+import glob
+import os
+import sys
+import time
+
+import numpy as np
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'photo_tagger')
+sys.path.append(root)
+sys.path.append(os.path.join(root, 'vision', 'SSH'))
+
+MODES = ['mtcnn', 'onet', 'lnet']
+
+
+def normalized_error(reference, landmark5):
+    '''
+        mean point distance normalized by inter-ocular distance of the reference
+    '''
+    iod = np.linalg.norm(reference[0] - reference[1])
+    return np.linalg.norm(reference - landmark5, axis=1).mean() / max(iod, 1.0)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='accuracy and latency of SSH seeded landmarks against full MTCNN')
+    parser.add_argument('images', help='glob of test images')
+    parser.add_argument('--ctx-id', type=int, default=0, help='gpu id, negative for cpu')
+    parser.add_argument('--recognition-model', default=os.path.join(root, 'vision/models/model-r100-ii/model'))
+    parser.add_argument('--ssh-model', default=os.path.join(root, 'vision/SSH/model/e2ef'))
+    parser.add_argument('--mtcnn-model', default=os.path.join(root, 'vision/mtcnn-model/'))
+    args = parser.parse_args()
+
+    import cv2
+    from vision.photo_analysis import VectorExtractor
+
+    paths = sorted(glob.glob(args.images))
+    extractor = VectorExtractor(args.recognition_model, args.ssh_model, args.mtcnn_model,
+                [1200, 1600], 0.5, args.ctx_id)
+
+    seconds = dict((mode, 0.0) for mode in MODES)
+    accepted = dict((mode, 0) for mode in MODES)
+    errors = dict((mode, []) for mode in MODES)
+    num_faces = 0
+    for path in paths:
+        img = extractor._preprocess(cv2.imread(path))
+        faces = extractor._detect_batch([img])[0]
+        num_faces += len(faces)
+
+        landmarks = {}
+        for mode in MODES:
+            extractor.landmark_mode = mode
+            # first call warms up executors for this shape
+            extractor._landmarks(img, faces)
+            start = time.time()
+            landmarks[mode] = extractor._landmarks(img, faces)
+            seconds[mode] += time.time() - start
+            accepted[mode] += sum(landmark5 is not None for landmark5 in landmarks[mode])
+
+        for mode in MODES:
+            for reference, landmark5 in zip(landmarks['mtcnn'], landmarks[mode]):
+                if reference is not None and landmark5 is not None:
+                    errors[mode].append(normalized_error(reference, landmark5))
+
+    print('photos:', len(paths), 'faces:', num_faces)
+    print('%-6s %10s %10s %10s %10s' % ('mode', 'ms/photo', 'accepted', 'NME mean', 'NME p95'))
+    for mode in MODES:
+        nme = np.array(errors[mode]) if len(errors[mode]) > 0 else np.zeros(1)
+        print('%-6s %10.2f %10d %10.4f %10.4f' % (mode, 1000.0 * seconds[mode] / max(len(paths), 1),
+              accepted[mode], nme.mean(), np.percentile(nme, 95)))
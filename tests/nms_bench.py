@@ -0,0 +1,103 @@
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'photo_tagger')
+sys.path.append(root)
+sys.path.append(os.path.join(root, 'vision', 'SSH'))
+
+from rcnn.processing import nms as rcnn_nms
+
+
+def delete_loop_nms(boxes, overlap_threshold, mode='Union'):
+    '''
+        former vision.helper.nms, np.delete on every iteration
+    '''
+    x1, y1, x2, y2, score = [boxes[:, i] for i in range(5)]
+    area = (x2 - x1 + 1) * (y2 - y1 + 1)
+    idxs = np.argsort(score)
+    pick = []
+    while len(idxs) > 0:
+        last = len(idxs) - 1
+        i = idxs[last]
+        pick.append(i)
+        xx1 = np.maximum(x1[i], x1[idxs[:last]])
+        yy1 = np.maximum(y1[i], y1[idxs[:last]])
+        xx2 = np.minimum(x2[i], x2[idxs[:last]])
+        yy2 = np.minimum(y2[i], y2[idxs[:last]])
+        inter = np.maximum(0, xx2 - xx1 + 1) * np.maximum(0, yy2 - yy1 + 1)
+        if mode == 'Min':
+            overlap = inter / np.minimum(area[i], area[idxs[:last]])
+        else:
+            overlap = inter / (area[i] + area[idxs[:last]] - inter)
+        idxs = np.delete(idxs, np.concatenate(([last], np.where(overlap > overlap_threshold)[0])))
+    return pick
+
+
+def make_boxes(num, rng):
+    '''
+        proposals clustered around faces as detectors produce them
+    '''
+    centers = rng.rand(max(int(np.sqrt(num)), 1), 2) * 2000
+    ctr = centers[rng.randint(0, len(centers), num)] + rng.randn(num, 2) * 10
+    wh = rng.rand(num, 2) * 60 + 20
+    return np.hstack([np.round(ctr - wh / 2), np.round(ctr + wh / 2), rng.rand(num, 1)]).astype(np.float32)
+
+
+def timed(func, repeat):
+    start = time.time()
+    for _ in range(repeat):
+        func()
+    return (time.time() - start) / repeat
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='NMS engine against former implementations')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000, 10000, 100000])
+    parser.add_argument('--threshold', type=float, default=0.3)
+    parser.add_argument('--budget', type=float, default=5.0, help='skip an implementation at larger sizes once it takes longer')
+    args = parser.parse_args()
+
+    kernel = rcnn_nms._box_nms
+    print('compiled kernel:', kernel is not None, 'cpu_nms:', rcnn_nms.cpu_nms is not None)
+
+    def fallback(dets, thresh):
+        rcnn_nms._box_nms = None
+        try:
+            return rcnn_nms.box_nms(dets, thresh)
+        finally:
+            rcnn_nms._box_nms = kernel
+
+    methods = [
+        ('helper delete loop', lambda dets, thresh: delete_loop_nms(dets, thresh)),
+        ('rcnn py_nms', rcnn_nms.nms),
+        ('engine fallback', fallback),
+    ]
+    if rcnn_nms.cpu_nms is not None:
+        methods.append(('rcnn cpu_nms', rcnn_nms.cpu_nms))
+    if kernel is not None:
+        methods.append(('engine kernel', lambda dets, thresh: rcnn_nms.box_nms(dets, thresh)))
+        methods.append(('engine top 100', lambda dets, thresh: rcnn_nms.box_nms(dets, thresh, max_keep=100)))
+
+    rng = np.random.RandomState(0)
+    over_budget = set()
+    print('%-20s' % 'boxes' + ''.join('%12d' % size for size in args.sizes))
+    results = dict((name, []) for name, _ in methods)
+    for size in args.sizes:
+        dets = make_boxes(size, rng)
+        repeat = max(1, 1000 // size)
+        for name, method in methods:
+            if name in over_budget:
+                results[name].append(None)
+                continue
+            seconds = timed(lambda: method(dets, args.threshold), repeat)
+            results[name].append(seconds)
+            if seconds > args.budget:
+                over_budget.add(name)
+
+    for name, _ in methods:
+        print('%-20s' % name + ''.join('%12s' % ('-' if seconds is None else '%.2f ms' % (1000.0 * seconds))
+                                       for seconds in results[name]))
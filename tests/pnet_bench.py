@@ -0,0 +1,85 @@
+import argparse
+import glob
+import os
+import sys
+import time
+from itertools import repeat
+from multiprocessing import Pool
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'photo_tagger')
+sys.path.append(root)
+
+
+def detect_first_stage_wrapper(args):
+    from vision.helper import detect_first_stage
+    return detect_first_stage(*args)
+
+
+def report(name, count, seconds):
+    print('%-8s %10.3f %10.2f' % (name, seconds, 1000.0 * seconds / max(count, 1)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='MTCNN first stage: Pool against shared memory workers and single process')
+    parser.add_argument('images', help='glob of test images')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--max-size', type=int, default=640, help='longest side of images fed to MTCNN')
+    parser.add_argument('--mtcnn-model', default=os.path.join(root, 'vision/mtcnn-model/'))
+    args = parser.parse_args()
+
+    import cv2
+    import mxnet as mx
+    import numpy as np
+    from vision.helper import detect_first_stage
+    from vision.mtcnn_detector import MtcnnDetector
+    from vision.first_stage import PNetWorkers
+
+    images = []
+    for path in sorted(glob.glob(args.images)):
+        img = cv2.imread(path)
+        scale = min(1.0, float(args.max_size) / max(img.shape[0:2]))
+        images.append(cv2.resize(img, None, None, fx=scale, fy=scale))
+
+    detector = MtcnnDetector(args.mtcnn_model, num_worker=1, ctx=mx.cpu())
+    prefix = os.path.join(args.mtcnn_model, 'det1')
+    threshold = detector.threshold[0]
+
+    # the former path: image and PNet are pickled to the pool for every scale
+    pool = Pool(args.workers)
+    pool_nets = [mx.model.FeedForward.load(prefix, 1, ctx=mx.cpu(i)) for i in range(args.workers)]
+
+    def run_pool(img, scales):
+        boxes = []
+        for start in range(0, len(scales), args.workers):
+            batch = scales[start:start + args.workers]
+            boxes.extend(pool.map(detect_first_stage_wrapper,
+                            zip(repeat(img), pool_nets[:len(batch)], batch, repeat(threshold))))
+        return boxes
+
+    workers = PNetWorkers(prefix, args.workers)
+    modes = [
+        ('single', lambda img, scales: [detect_first_stage(img, detector.PNets[0], scale, threshold) for scale in scales]),
+        ('pool', run_pool),
+        ('shared', lambda img, scales: workers.run([img], scales, threshold, detector.PNets[0])[0]),
+    ]
+
+    print('images:', len(images), 'workers:', args.workers, 'max size:', args.max_size)
+    print('%-8s %10s %10s' % ('mode', 'seconds', 'ms/image'))
+    reference = None
+    for name, run in modes:
+        # warm up executors for every pyramid level
+        run(images[0], detector.pyramid_scales(*images[0].shape[0:2]))
+        results = []
+        start = time.time()
+        for img in images:
+            results.append(run(img, detector.pyramid_scales(*img.shape[0:2])))
+        report(name, len(images), time.time() - start)
+
+        counts = [sum(len(boxes) for boxes in result if boxes is not None) for result in results]
+        if reference is None:
+            reference = counts
+        elif counts != reference:
+            print('  box counts differ from single process')
+
+    workers.close()
+    pool.close()
@@ -0,0 +1,77 @@
+import argparse
+import glob
+import os
+import sys
+import time
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'photo_tagger')
+sys.path.append(root)
+sys.path.append(os.path.join(root, 'vision', 'SSH'))
+
+from vision import device
+
+
+def report(name, count, seconds, unit='images'):
+    rate = count / seconds if seconds > 0 else float('inf')
+    print('%-12s %6d %s in %8.3fs  %8.2f %s/sec' % (name, count, unit, seconds, rate, unit))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='per stage throughput of the vision pipeline')
+    parser.add_argument('images', help='glob of test images')
+    parser.add_argument('--ctx-id', type=int, default=-1, help='gpu id, negative for cpu')
+    parser.add_argument('--threads', type=int, default=0, help='cpu threads per process')
+    parser.add_argument('--recognition-model', default=os.path.join(root, 'vision/models/model-r100-ii/model'))
+    parser.add_argument('--ssh-model', default=os.path.join(root, 'vision/SSH/model/e2ef'))
+    parser.add_argument('--mtcnn-model', default=os.path.join(root, 'vision/mtcnn-model/'))
+    parser.add_argument('--warmup', type=int, default=2)
+    args = parser.parse_args()
+
+    device.configure_cpu(args.threads)
+    from vision.photo_analysis import VectorExtractor
+
+    paths = sorted(glob.glob(args.images))
+    extractor = VectorExtractor(args.recognition_model, args.ssh_model, args.mtcnn_model,
+                [1200, 1600], 0.5, args.ctx_id)
+
+    timings = {'decode': 0.0, 'detect': 0.0, 'landmarks': 0.0, 'embedding': 0.0}
+    num_faces = 0
+    num_landmarks = 0
+    for it, path in enumerate(paths[:args.warmup] + paths):
+        warmup = it < args.warmup
+
+        start = time.time()
+        img = extractor._load(path)
+        decode = time.time() - start
+
+        start = time.time()
+        faces = extractor._detect_batch([img])[0]
+        detect = time.time() - start
+
+        start = time.time()
+        landmarks = [landmark5 for landmark5 in extractor._landmarks(img, faces) if landmark5 is not None]
+        align = time.time() - start
+
+        start = time.time()
+        extractor._predict_batch([img], [landmarks])
+        embed = time.time() - start
+
+        if warmup:
+            continue
+
+        timings['decode'] += decode
+        timings['detect'] += detect
+        timings['landmarks'] += align
+        timings['embedding'] += embed
+        num_faces += len(faces)
+        num_landmarks += len(landmarks)
+
+    print('device:', 'cpu' if args.ctx_id < 0 else 'gpu(%d)' % args.ctx_id,
+          'mkldnn:', device.mkldnn_enabled(), 'threads:', args.threads)
+    report('decode', len(paths), timings['decode'])
+    report('detect', len(paths), timings['detect'])
+    report('landmarks', len(paths), timings['landmarks'])
+    report('embedding', len(paths), timings['embedding'])
+    report('landmarks', num_faces, timings['landmarks'], 'faces')
+    report('embedding', num_landmarks, timings['embedding'], 'faces')
+    report('total', len(paths), sum(timings.values()))